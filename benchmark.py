@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark suite for the psd module
+# usage: python benchmark.py [width height] [options]
+#   python benchmark.py --help for the options
+# The PSD files are generated (see generate_psd), results can be written as
+# JSON (--json) to track regressions between releases.
+
+import os
+import json
+import time
+import platform
+import argparse
+import tempfile
+import numpy as np
+
+from buffer import Buffer
+from psd import PsdFile, PsdLayer, load_psd, get_bounding_boxes, _read_compressed_layer, _pack_bits
+
+
+def _read_compressed_layer_legacy(buf, w, h):
+	# byte per byte PackBits decoder, as used before the vectorized one
+	buf.save_state()
+	for _ in range(h):
+		buf.read_w()
+	size = w*h
+	unc = np.zeros(size, dtype = np.uint8)
+	i = 0
+
+	while i < size:
+		hdr = buf.read_b(signed = True)
+		if hdr >= 0:
+			n = hdr + 1
+			unc[i : i + n] = buf.data[buf.index : buf.index + n]
+			i += n
+			buf.index += n
+		elif hdr > -128:
+			v = buf.read_b()
+			n = 1 - hdr
+			unc[i : i + n] = v
+			i += n
+	unc.shape = (h, w)
+
+	buf.restore_state()
+	return unc
+
+def make_rle_channel(w, h, seed=0):
+	# build a PackBits compressed channel (row byte counts + rows) made of
+	# a random mix of literal and repeated runs, like a typical layer
+	rng = np.random.default_rng(seed)
+	expected = np.zeros((h, w), dtype=np.uint8)
+	rows = []
+	for y in range(h):
+		row = bytearray()
+		x = 0
+		while x < w:
+			n = min(w - x, int(rng.integers(1, 129)))
+			if rng.random() < 0.5:
+				v = int(rng.integers(0, 256))
+				if n == 1:
+					row += bytes([0, v])
+				else:
+					row += bytes([257 - n, v])
+				expected[y, x : x + n] = v
+			else:
+				values = rng.integers(0, 256, n, dtype=np.uint8)
+				row += bytes([n - 1]) + values.tobytes()
+				expected[y, x : x + n] = values
+			x += n
+		rows += [row]
+
+	data = bytearray()
+	for row in rows:
+		data += len(row).to_bytes(2, 'big')
+	for row in rows:
+		data += row
+	return data, expected
+
+def make_image(w, h, rng, sparsity=0.):
+	# (h, w*4) RGBA PngArray: smooth gradients with some noise (so that RLE
+	# finds both runs and literals), sparsity is the fraction of fully
+	# transparent pixels
+	y, x = np.mgrid[0:h, 0:w]
+	image = np.empty((h, w, 4), dtype=np.uint8)
+	image[:, :, 0] = (x * 255 // max(w - 1, 1)).astype(np.uint8)
+	image[:, :, 1] = (y * 255 // max(h - 1, 1)).astype(np.uint8)
+	image[:, :, 2] = rng.integers(0, 256)
+	noisy = rng.random((h, w)) < 0.1
+	image[:, :, 2][noisy] = rng.integers(0, 256, int(noisy.sum()), dtype=np.uint8)
+	image[:, :, 3] = 255
+	if sparsity:
+		image[rng.random((h, w)) < sparsity] = 0
+	return image.reshape(h, w*4)
+
+def make_psd(width, height, nb_layers=4, sparsity=0., compression=1, seed=0):
+	# PsdFile of nb_layers layers; each layer covers a random rectangle of
+	# (1 - sparsity) of the canvas area, and has sparsity transparent pixels
+	rng = np.random.default_rng(seed)
+	psd = PsdFile(size=(width, height), layers=[], compression=compression)
+	scale = (1. - sparsity) ** .5
+	for i in range(nb_layers):
+		w, h = max(1, int(width * scale)), max(1, int(height * scale))
+		x, y = int(rng.integers(0, width - w + 1)), int(rng.integers(0, height - h + 1))
+		psd.add_layer(PsdLayer("Layer %d" % i, (x, y), image=make_image(w, h, rng, sparsity)))
+	return psd
+
+def generate_psd(path, width, height, nb_layers=4, sparsity=0., compression=1, seed=0):
+	# write a synthetic PSD file, see make_psd
+	make_psd(width, height, nb_layers, sparsity, compression, seed).save(path)
+	return path
+
+def make_layers_psd(w, h, nb_layers=4, seed=0):
+	# PsdFile with nb_layers random layers covering the canvas
+	rng = np.random.default_rng(seed)
+	psd = PsdFile(layers=[])
+	for i in range(nb_layers):
+		image = rng.integers(0, 256, (h, w*4), dtype=np.uint8)
+		image[:, 3::4] = 255
+		psd.add_layer(PsdLayer("Layer %d" % i, image=image))
+	return psd
+
+def _timeit(f, *args, repeat=3):
+	best = None
+	for _ in range(repeat):
+		t = time.perf_counter()
+		res = f(*args)
+		t = time.perf_counter() - t
+		if best is None or t < best:
+			best = t
+	return best, res
+
+class Results:
+	# results of the benchmarks, printed as they come and saved as JSON
+	def __init__(self, params, repeat=3):
+		self.params = params
+		self.repeat = repeat
+		self.entries = []
+		self.group = None
+
+	def start(self, group):
+		self.group = group
+		print(group)
+
+	def run(self, name, f, *args, size=None, **params):
+		# time f(*args) (best of repeat runs); size: number of bytes
+		# processed, for the throughput
+		t, res = _timeit(f, *args, repeat=self.repeat)
+		entry = {"group": self.group, "name": name, "seconds": t, "params": params}
+		if size:
+			entry["bytes"] = size
+			entry["mb_per_s"] = size / 1e6 / t
+			print("  %-24s %8.3f s %10.1f MB/s" % (name, t, entry["mb_per_s"]))
+		else:
+			print("  %-24s %8.3f s" % (name, t))
+		self.entries += [entry]
+		return res
+
+	def save(self, path):
+		report = {
+			"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			"python": platform.python_version(),
+			"numpy": np.__version__,
+			"machine": platform.machine(),
+			"platform": platform.platform(),
+			"cpu_count": os.cpu_count(),
+			"params": self.params,
+			"results": self.entries
+		}
+		f = open(path, 'w')
+		json.dump(report, f, indent=1)
+		f.close()
+
+def bench_rle_decode(results, w, h, legacy=True):
+	data, expected = make_rle_channel(w, h)
+	results.start("RLE decode %dx%d (%d bytes compressed)" % (w, h, len(data)))
+	decoders = [("vectorized", _read_compressed_layer)]
+	if legacy:
+		decoders = [("legacy", _read_compressed_layer_legacy)] + decoders
+	for name, f in decoders:
+		res = results.run(name, lambda: f(Buffer(data), w, h), size=w*h, width=w, height=h)
+		assert (res == expected).all()
+
+def bench_rle_encode(results, w, h):
+	_, channel = make_rle_channel(w, h)
+	image = make_image(w, h, np.random.default_rng(0))[:, 0::4]
+	results.start("RLE encode %dx%d" % (w, h))
+	results.run("random runs", _pack_bits, channel, size=w*h, width=w, height=h)
+	results.run("gradient", _pack_bits, np.ascontiguousarray(image), size=w*h, width=w, height=h)
+
+def bench_buffer_read(results, n=200000):
+	buf = Buffer(bytearray(np.arange(n * 6, dtype=np.uint8) & 0x7F))
+
+	def read_words():
+		buf.set_index(0)
+		for _ in range(n):
+			buf.read_w()
+			buf.read_l()
+
+	def read_strings():
+		buf.set_index(0)
+		for _ in range(n // 4):
+			buf.read_string(n_chars=4)
+
+	def read_arrays():
+		for i in range(n // 1000):
+			buf.read_array(6000, np.uint8, i * 6000)
+
+	results.start("Buffer read")
+	results.run("read_w/l", read_words, size=6*n, count=n)
+	results.run("read_string", read_strings, size=n, count=n // 4)
+	results.run("read_array", read_arrays, size=6*n, count=n // 1000)
+
+def bench_buffer_write(results, n=200000):
+	def write_words():
+		buf = Buffer()
+		for i in range(n):
+			buf.write_w(i & 0xFFFF)
+			buf.write_l(i)
+		return buf
+
+	def write_arrays():
+		buf = Buffer()
+		for _ in range(n // 1000):
+			buf.write(chunk)
+		return buf
+
+	chunk = np.arange(0x10000, dtype=np.uint32).view(np.uint8)
+	results.start("Buffer write")
+	results.run("write_w/l", write_words, size=6*n, count=n)
+	results.run("write", write_arrays, size=n // 1000 * len(chunk), count=n // 1000)
+
+def bench_bounding_box(results, w, h, nb_images=16, sparsity=.5):
+	rng = np.random.default_rng(0)
+	images = [make_image(w, h, rng, sparsity) for _ in range(nb_images)]
+	for image in images:
+		# transparent margins
+		image[: h // 8] = 0
+		image[:, : w // 2] = 0
+	results.start("Bounding boxes %dx%d" % (w, h))
+	results.run("get_bounding_boxes", get_bounding_boxes, images, size=nb_images*w*h*4, width=w, height=h, images=nb_images)
+
+def bench_save(results, psd, path):
+	w, h = psd.size
+	size = sum(layer.size[0] * layer.size[1] * 4 for layer in psd.layers)
+	results.start("PsdFile.save %dx%d, %d layers" % (w, h, psd.nb_layers))
+	for compression in (0, 1, 2, 3):
+		results.run("compression=%d" % compression, lambda: psd.save(path, compression), size=size, compression=compression)
+		results.entries[-1]["file_size"] = os.path.getsize(path)
+
+def bench_load(results, path):
+	psd = load_psd(path)
+	w, h = psd.size
+	size = sum(layer.size[0] * layer.size[1] * 4 for layer in psd.layers)
+	results.start("load_psd %dx%d, %d layers (%d bytes)" % (w, h, psd.nb_layers, os.path.getsize(path)))
+	results.run("eager", load_psd, path, size=size, mode="eager")
+	results.run("memory_map", lambda: load_psd(path, memory_map=True), size=size, mode="memory_map")
+	results.run("lazy", lambda: load_psd(path, lazy=True), size=size, mode="lazy")
+	results.run("threads", lambda: load_psd(path, workers=os.cpu_count()), size=size, mode="threads")
+
+def bench_fusion(results, path):
+	psd = load_psd(path)
+	w, h = psd.size
+	results.start("get_fusioned_image %dx%d, %d layers" % (w, h, psd.nb_layers))
+	psd.cache_composite = False
+	results.run("serial", lambda: psd.get_fusioned_image(workers=1), size=w*h*4, workers=1)
+	results.run("threads", lambda: psd.get_fusioned_image(), size=w*h*4, workers=None)
+	psd.cache_composite = True
+	psd.get_fusioned_image()
+	results.run("cached", lambda: psd.get_fusioned_image(), size=w*h*4, cached=True)
+
+
+benchmarks = ["rle", "buffer", "bbox", "save", "load", "fusion"]
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="psd module benchmarks")
+	parser.add_argument("size", nargs="*", type=int, help="canvas width and height (default 2048 2048)")
+	parser.add_argument("--layers", type=int, default=4, help="number of layers of the generated file")
+	parser.add_argument("--sparsity", type=float, default=0., help="fraction of transparent pixels (0 ... 1)")
+	parser.add_argument("--compression", type=int, default=1, help="compression of the generated file (0 ... 3)")
+	parser.add_argument("--repeat", type=int, default=3, help="runs of each benchmark (the best is kept)")
+	parser.add_argument("--only", action="append", choices=benchmarks, help="run only these benchmarks")
+	parser.add_argument("--no-legacy", action="store_true", help="skip the slow legacy RLE decoder")
+	parser.add_argument("--json", help="write the results to this file")
+	args = parser.parse_args()
+
+	if len(args.size) == 2:
+		width, height = args.size
+	elif not args.size:
+		width, height = 2048, 2048
+	else:
+		parser.error("expected width and height")
+
+	params = {
+		"width": width, "height": height, "layers": args.layers,
+		"sparsity": args.sparsity, "compression": args.compression
+	}
+	results = Results(params, args.repeat)
+	only = args.only or benchmarks
+
+	if "rle" in only:
+		bench_rle_decode(results, width, height, not args.no_legacy)
+		bench_rle_encode(results, width, height)
+	if "buffer" in only:
+		bench_buffer_read(results)
+		bench_buffer_write(results)
+	if "bbox" in only:
+		bench_bounding_box(results, width, height)
+
+	tmp_dir = tempfile.mkdtemp()
+	path = os.path.join(tmp_dir, "benchmark.psd")
+	try:
+		psd = make_psd(width, height, args.layers, args.sparsity, args.compression)
+		psd.save(path)
+		if "save" in only:
+			bench_save(results, psd, os.path.join(tmp_dir, "saved.psd"))
+		if "load" in only:
+			bench_load(results, path)
+		if "fusion" in only:
+			bench_fusion(results, path)
+	finally:
+		for name in os.listdir(tmp_dir):
+			os.remove(os.path.join(tmp_dir, name))
+		os.rmdir(tmp_dir)
+
+	if args.json:
+		results.save(args.json)
@@ -1,9 +1,34 @@
 import sys
 sys.path.append('..')
 
-import numpy, codecs, os
+import numpy, codecs, os, mmap, struct
 ascii_table = "".join([chr(i) for i in range(255)])
 
+_formats = {
+	(2, False): struct.Struct('>H'),
+	(2, True): struct.Struct('>h'),
+	(4, False): struct.Struct('>L'),
+	(4, True): struct.Struct('>l'),
+	(8, False): struct.Struct('>Q'),
+	(8, True): struct.Struct('>q'),
+}
+
+def _as_bytes(buf):
+	# flat byte view of buf, without copy when possible
+	if isinstance(buf, Buffer):
+		return memoryview(buf.data)[buf.start : buf.length]
+	if isinstance(buf, list):
+		return bytearray(buf)
+	if isinstance(buf, numpy.ndarray):
+		buf = numpy.ascontiguousarray(buf)
+	return memoryview(buf).cast('B')
+
+def file_stat(fd):
+	# identity and version of an open file, to detect it was replaced or
+	# modified
+	st = os.fstat(fd)
+	return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
 class Buffer():
 	def __init__(self, 
 				 data = None,
@@ -15,12 +40,20 @@ class Buffer():
 #			self.data = numpy.array(data, dtype = numpy.uint8)
 			self.data = data
 		else:
-			self.data = []
+			self.data = bytearray()
+		# data may be larger than its content (see reserve)
+		self.length = len(self.data)
 		self.start = start
 		self.stop = stop
 		self.index = index
 		
 		self.states = []
+		# file the data was loaded from (see Buffer.load), position of data[0]
+		# in this file, and (st_dev, st_ino, st_size, st_mtime_ns) of the file
+		# when it was read
+		self.path = None
+		self.path_offset = 0
+		self.path_stat = None
 		
 		self.current_bit = self.current_nib = 0
 		self.byte_of_nib = self.byte_of_bit = 0
@@ -33,18 +66,30 @@ class Buffer():
 		self.index, self.current_bit, self.current_nib = self.states.pop()
 
 	def __len__(self):
-		return len(self.data) - self.start
+		return self.length - self.start
 
 	@staticmethod
-	def load(path, offset = 0):
+	def load(path, offset = 0, memory_map = False):
 		f = open(path, 'rb')
-		data = bytearray(f.read())
-		f.close()
-		return Buffer(data[offset : ])
+		path_stat = file_stat(f.fileno())
+		if memory_map:
+			# copy-on-write mapping: data is only paged in when read,
+			# and writes never reach the file
+			data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_COPY)
+			f.close()
+			res = Buffer(data, start = offset)
+		else:
+			f.seek(offset)
+			res = Buffer(bytearray(f.read()))
+			res.path_offset = offset
+			f.close()
+		res.path = path
+		res.path_stat = path_stat
+		return res
 
 	def save(self, path):
 		f = open(path, 'wb')
-		f.write(bytearray(self.data))
+		f.write(memoryview(self.data)[:self.length])
 		f.close()
 	
 	def __getitem__(self, val):
@@ -113,31 +158,46 @@ class Buffer():
 		if pos == -1:
 			pos = self.index
 			self.index += 2
-		val = self[pos] * 256 + self[pos + 1]
-
-		if signed and val >= 32768:
-			val -= 65536
-
-		return val
+		return _formats[2, signed].unpack_from(self.data, self.start + pos)[0]
 
 	def read_l(self, pos = -1, signed = False):
 		if pos == -1:
 			pos = self.index
 			self.index += 4
-		val = self[pos] * 0x1000000 + self[pos + 1] * 0x10000 \
-			  + self[pos + 2] * 0x100 + self[pos + 3]
+		return _formats[4, signed].unpack_from(self.data, self.start + pos)[0]
 
-		if signed and val >= 0x80000000:
-			val -= 0x100000000
-		
-		if not signed and val < 0:
-			val += 0x100000000
+	def read_q(self, pos = -1, signed = False):
+		# 64 bits value
+		if pos == -1:
+			pos = self.index
+			self.index += 8
+		return _formats[8, signed].unpack_from(self.data, self.start + pos)[0]
+
+	def read_array(self, count, dtype = numpy.uint8, pos = -1):
+		# count values of type dtype (e.g. '>u2' for big endian words),
+		# as a read only view on the data
+		dtype = numpy.dtype(dtype)
+		if pos == -1:
+			pos = self.index
+			self.index += count * dtype.itemsize
+		res = numpy.frombuffer(self.data, dtype = dtype, count = count, offset = self.start + pos)
+		res.flags.writeable = False
+		return res
 
-		return val
-	
 	def read_string(self, pos = -1, table = ascii_table, end_char = 0x00, n_chars = 1000000):
 		if pos >= 0:
 			self.save_state()
+
+		if table is ascii_table:
+			# fast path: every byte is a character of the table
+			start = self.start + self.index
+			chunk = bytes(self.data[start : start + n_chars])
+			if len(chunk) == n_chars and 0xFF not in chunk:
+				self.index += n_chars
+				if pos >= 0:
+					self.restore_state()
+				return chunk.decode('latin-1')
+
 		res = u''
 		i = 0
 
@@ -254,10 +314,17 @@ class Buffer():
 	def enlarge(self, sz):
 		self._check_pos(sz - 1)
 
+	def reserve(self, sz):
+		# make room for sz bytes without changing the length
+		if sz > len(self.data):
+			self.data += bytearray(sz - len(self.data))
+
 	def _check_pos(self, pos):
 		if pos >= len(self.data):
-			self.data += bytearray([0]) * (pos - len(self.data) + 1)
-#		self.length = max(self.length, pos + 1)
+			# grow by doubling the capacity so that appends are amortized O(1)
+			self.reserve(max(pos + 1, 2 * len(self.data)))
+		if pos >= self.length:
+			self.length = pos + 1
 
 	def write_b(self, val, pos = -1, signed = False):
 		if signed and val < 0:
@@ -282,8 +349,7 @@ class Buffer():
 			self.byte_of_nib = self.byte_of_bit = 0
 			
 		self._check_pos(pos + 1)
-		self.data[pos] = val // 0x100
-		self.data[pos + 1] = val % 0x100
+		_formats[2, False].pack_into(self.data, pos, val)
 		return pos
  
 	def write_l(self, val, pos = -1, signed = False):
@@ -296,10 +362,21 @@ class Buffer():
 			self.byte_of_nib = self.byte_of_bit = 0
 
 		self._check_pos(pos + 3)
-		self.data[pos] = val // 0x1000000
-		self.data[pos + 1] = (val // 0x10000) % 0x100
-		self.data[pos + 2] = (val // 0x100) % 0x100
-		self.data[pos + 3] = val % 0x100
+		_formats[4, False].pack_into(self.data, pos, val)
+		return pos
+
+	def write_q(self, val, pos = -1, signed = False):
+		# 64 bits value
+		if signed and val < 0:
+			return self.write_q(val + 0x10000000000000000, pos)
+		if pos == -1:
+			pos = self.index
+			self.index += 8
+		else:
+			self.byte_of_nib = self.byte_of_bit = 0
+
+		self._check_pos(pos + 7)
+		_formats[8, False].pack_into(self.data, pos, val)
 		return pos
 
 	def write_hex(self, string, pos_ = -1):
@@ -336,22 +413,25 @@ class Buffer():
 
 
 	def write(self, buf, pos = -1):
+		# buf: hex string, list of bytes, Buffer, or any object supporting
+		# the buffer protocol (bytes, bytearray, memoryview, numpy array...)
 		if isinstance(buf, str):
 			return self.write_hex(buf, pos)
 		else:
+			data = _as_bytes(buf)
 			if pos == -1:
 				pos = self.index
-				self.index += len(buf)
-			self._check_pos(pos + len(buf) - 1)
-	#		print 'len before =', len(self)
-			if type(buf) in [list, bytearray]:
-				self.data[pos : pos + len(buf)] = buf[:len(buf)]
-			else:
-				self.data[pos : pos + len(buf)] = list(buf.data[:len(buf)])
-	#		print 'len after =', len(self)
-	#		self.index += len(buf)
+				self.index += len(data)
+			if len(data):
+				self._check_pos(pos + len(data) - 1)
+				self.data[pos : pos + len(data)] = data
 			return pos
 
+	def write_from(self, source, pos, size):
+		# copy size bytes of the Buffer source, from pos
+		start = source.start + pos
+		return self.write(memoryview(source.data)[start : start + size])
+
 	def write_nibble(self, v, mode_ = 0):
 #		print type(self.byte_of_nib), 'byte_of_nib = %X' % self.byte_of_nib
 #		print 'write nibble %X, byte_of_nib = %08X' % (v, self.byte_of_nib)
@@ -627,6 +707,94 @@ class Buffer():
 		
 		self.index = addr + length
 
+class FileBuffer(Buffer):
+	# Write only Buffer sending its data straight to a seekable file object.
+	# Writing at an explicit position (e.g. to patch a length field once the
+	# data it describes is written) seeks there and back.
+	def __init__(self, f):
+		Buffer.__init__(self)
+		self.file = f
+		self.index = f.tell()
+
+	def __len__(self):
+		return self.index
+
+	def _write_bytes(self, data, pos):
+		if pos == -1:
+			pos = self.index
+			self.file.write(data)
+			self.index += len(data)
+		else:
+			self.byte_of_nib = self.byte_of_bit = 0
+			self.file.seek(pos)
+			self.file.write(data)
+			self.file.seek(self.index)
+		return pos
+
+	def write_b(self, val, pos = -1, signed = False):
+		if signed and val < 0:
+			val += 0x100
+		return self._write_bytes(struct.pack('>B', val), pos)
+
+	def write_w(self, val, pos = -1, signed = False):
+		if signed and val < 0:
+			val += 0x10000
+		return self._write_bytes(struct.pack('>H', val), pos)
+
+	def write_l(self, val, pos = -1, signed = False):
+		if signed and val < 0:
+			val += 0x100000000
+		return self._write_bytes(struct.pack('>L', val), pos)
+
+	def write_q(self, val, pos = -1, signed = False):
+		if signed and val < 0:
+			val += 0x10000000000000000
+		return self._write_bytes(struct.pack('>Q', val), pos)
+
+	def write(self, buf, pos = -1):
+		if isinstance(buf, str):
+			return self.write_hex(buf, pos)
+		return self._write_bytes(_as_bytes(buf), pos)
+
+	def write_from(self, source, pos, size):
+		# when source was loaded from a file, the data is copied from file to
+		# file by the kernel (copy_file_range), without going through memory
+		if source.path is not None and hasattr(os, 'copy_file_range'):
+			try:
+				dst = self.file.fileno()
+				src = os.open(source.path, os.O_RDONLY)
+			except (AttributeError, OSError, ValueError):
+				# not a real file
+				src = None
+			if src is not None:
+				try:
+					# never from the file being written, nor from a file that
+					# changed since it was read
+					if file_stat(src) == source.path_stat and not os.path.samestat(os.fstat(src), os.fstat(dst)):
+						self.file.flush()
+						src_pos = source.path_offset + source.start + pos
+						copied = 0
+						while copied < size:
+							n = os.copy_file_range(src, dst, size - copied, src_pos + copied, self.index + copied)
+							if n == 0:
+								break
+							copied += n
+						if copied == size:
+							start = self.index
+							self.index += size
+							self.file.seek(self.index)
+							return start
+				except OSError:
+					# e.g. not supported by the file systems: copy through memory
+					pass
+				finally:
+					os.close(src)
+		return Buffer.write_from(self, source, pos, size)
+
+	def read_b(self, pos = -1, signed = False):
+		raise Exception("FileBuffer is write only")
+
+
 if __name__ == '__main__':
 	a = Buffer()
 	b = Buffer()
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+# Bulk conversions with the psd module
+# usage:
+#   python cli.py export-layers INPUT... -o OUTPUT_DIR
+#     each layer of the PSD files to OUTPUT_DIR/<file name>/<layer name>.png
+#   python cli.py flatten INPUT... -o OUTPUT_DIR
+#     merged image of the PSD files to OUTPUT_DIR/<file name>.png
+#   python cli.py from-pngs INPUT... -o OUTPUT_DIR
+#     one PSD file OUTPUT_DIR/<directory name>.psd per directory of PNG files
+# INPUT is a file, a directory or a glob pattern. The file names above are
+# relative to their INPUT (the directory, or the part of the pattern before
+# its first wildcard), so that the tree of the inputs is kept in
+# OUTPUT_DIR; inputs whose outputs would be the same fail. Files are
+# processed in a pool of processes (--workers), outputs newer than their
+# inputs are skipped unless --force is given. The exit code is 1 if a file
+# failed.
+
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import png
+from psd import PsdFile, load_psd, load_composite, _png_rows
+
+
+def _file_name(name):
+	# layer name usable as a file name
+	name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .')
+	return name or '_'
+
+def _is_up_to_date(outputs, inputs):
+	# all the outputs exist and are newer than all the inputs
+	try:
+		oldest = min(os.path.getmtime(path) for path in outputs)
+	except (OSError, ValueError):
+		return False
+	return oldest >= max(os.path.getmtime(path) for path in inputs)
+
+def _save_png(path, image):
+	# image: RGBA PngArray
+	data, bitdepth = _png_rows(image)
+	png.from_array(data, mode="RGBA;%d" % bitdepth).save(path)
+
+def _output_name(rel, extension=True):
+	# path of an output in the output directory, without extension, for an
+	# input path relative to its input root
+	if extension:
+		rel = os.path.splitext(rel)[0]
+	return os.path.join(*[_file_name(part) for part in os.path.normpath(rel).split(os.sep)])
+
+def _expand(inputs, extensions, directories=False):
+	# files (or directories) matching inputs, which are files, directories
+	# (searched recursively for files with the given extensions) or glob
+	# patterns
+	# returns a list of (path, path relative to its input root): the
+	# directory searched, the part of a pattern without wildcards, or the
+	# directory of a file
+	res = []
+	seen = set()
+	for path in inputs:
+		if glob.has_magic(path):
+			matches = glob.glob(path, recursive=True)
+			root = path
+			while glob.has_magic(root):
+				root = os.path.dirname(root)
+		else:
+			matches = [path]
+			root = os.path.dirname(os.path.normpath(path))
+		if not matches:
+			raise Exception("No such file: %s" % path)
+		root = root or os.curdir
+
+		found = []
+		for match in sorted(matches):
+			if directories:
+				if os.path.isdir(match):
+					found += [(match, os.path.relpath(match, root))]
+			elif os.path.isdir(match):
+				# relative to the directory itself when given as is
+				walk_root = root if glob.has_magic(path) else match
+				for dir_path, _, names in sorted(os.walk(match)):
+					found += [(os.path.join(dir_path, name), os.path.relpath(os.path.join(dir_path, name), walk_root)) for name in sorted(names) if name.lower().endswith(extensions)]
+			elif match.lower().endswith(extensions) or not glob.has_magic(path):
+				found += [(match, os.path.relpath(match, root))]
+
+		# inputs given several times are converted once
+		for match, rel in found:
+			key = os.path.realpath(match)
+			if key not in seen:
+				seen.add(key)
+				res += [(match, rel)]
+	return res
+
+def export_layers(path, output_dir, force=False, name=None):
+	# returns False if the outputs were up to date
+	# name: path of the layer directory in output_dir (see _output_name),
+	# the file name by default
+	psd = load_psd(path, lazy=True)
+	if name is None:
+		name = _output_name(os.path.basename(path))
+	layer_dir = os.path.join(output_dir, name)
+	# layers without pixels have no image to export
+	layers = [layer for layer in psd.layers if layer.section_type == 0 and layer.size[0] and layer.size[1]]
+
+	# one file per layer name, numbered when several layers have the same
+	outputs = []
+	used = set()
+	for layer in layers:
+		file_name = _file_name(layer.name)
+		n = 1
+		while file_name.lower() in used:
+			n += 1
+			file_name = "%s (%d)" % (_file_name(layer.name), n)
+		used.add(file_name.lower())
+		outputs += [os.path.join(layer_dir, file_name + ".png")]
+
+	if not force and outputs and _is_up_to_date(outputs, [path]):
+		return False
+
+	os.makedirs(layer_dir, exist_ok=True)
+	for layer, output in zip(layers, outputs):
+		# the cached interleaved data is released by evict
+		_save_png(output, layer.get_data(order="RGBA", copy=False))
+		layer.evict()
+	return True
+
+def flatten(path, output_dir, force=False, name=None):
+	# name: see export_layers
+	if name is None:
+		name = _output_name(os.path.basename(path))
+	output = os.path.join(output_dir, name + ".png")
+	if not force and _is_up_to_date([output], [path]):
+		return False
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	_save_png(output, load_composite(path, order="RGBA"))
+	return True
+
+def from_pngs(path, output_dir, force=False, compression=1, name=None):
+	# path: directory of png files, one layer per file, in name order (the
+	# first one at the bottom)
+	# name: see export_layers, the directory name by default
+	images = [os.path.join(path, image) for image in sorted(os.listdir(path)) if image.lower().endswith(".png")]
+	if not images:
+		raise Exception("No png file in %s" % path)
+	if name is None:
+		name = _output_name(os.path.basename(os.path.normpath(path)), extension=False)
+	output = os.path.join(output_dir, name + ".psd")
+	if not force and _is_up_to_date([output], images):
+		return False
+
+	psd = PsdFile.from_images(images, workers=1)
+	for layer in psd.layers:
+		layer.rename(os.path.splitext(os.path.basename(layer.name))[0])
+	os.makedirs(os.path.dirname(output), exist_ok=True)
+	psd.save(output, compression)
+	return True
+
+def _run(command, path, output_dir, force, compression, name):
+	# pool worker: returns (converted, elapsed time, error message)
+	t = time.perf_counter()
+	try:
+		if command == "export-layers":
+			converted = export_layers(path, output_dir, force, name)
+		elif command == "flatten":
+			converted = flatten(path, output_dir, force, name)
+		else:
+			converted = from_pngs(path, output_dir, force, compression, name)
+		return converted, time.perf_counter() - t, None
+	except Exception:
+		return False, time.perf_counter() - t, traceback.format_exc()
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog="psd", description="Bulk conversions of PSD files")
+	subparsers = parser.add_subparsers(dest="command", required=True)
+	for command, help_ in [
+		("export-layers", "export the layers of PSD files as PNG files"),
+		("flatten", "export the merged image of PSD files as PNG files"),
+		("from-pngs", "build a PSD file from each directory of PNG files")
+	]:
+		subparser = subparsers.add_parser(command, help=help_)
+		subparser.add_argument("inputs", nargs="+", help="files, directories or glob patterns")
+		subparser.add_argument("-o", "--output", required=True, help="output directory")
+		subparser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default: number of CPUs)")
+		subparser.add_argument("-f", "--force", action="store_true", help="convert even if the outputs are up to date")
+		subparser.add_argument("-q", "--quiet", action="store_true", help="only report failures")
+		if command == "from-pngs":
+			subparser.add_argument("-c", "--compression", type=int, default=1, choices=(0, 1, 2, 3), help="compression of the PSD files (default: 1, RLE)")
+	args = parser.parse_args(argv)
+
+	try:
+		if args.command == "from-pngs":
+			paths = _expand(args.inputs, (".png",), directories=True)
+		else:
+			paths = _expand(args.inputs, (".psd", ".psb"))
+	except Exception as e:
+		print("psd: %s" % e, file=sys.stderr)
+		return 2
+	compression = getattr(args, "compression", 1)
+
+	# inputs with the same output (e.g. a/x.psd and b/x.psd given as files)
+	# fail, rather than overwriting each other
+	names = [_output_name(rel, extension=args.command != "from-pngs") for _, rel in paths]
+	inputs_by_name = {}
+	for (path, _), name in zip(paths, names):
+		inputs_by_name.setdefault(name.lower(), []).append(path)
+
+	t = time.perf_counter()
+	converted = skipped = failed = 0
+	i = 0
+	for (path, _), name in zip(paths, names):
+		others = [other for other in inputs_by_name[name.lower()] if other != path]
+		if others:
+			failed += 1
+			i += 1
+			print("[%d/%d] FAILED %s: same output as %s" % (i, len(paths), path, ", ".join(others)), file=sys.stderr)
+
+	with ProcessPoolExecutor(args.workers) as executor:
+		futures = {
+			executor.submit(_run, args.command, path, args.output, args.force, compression, name): path
+			for (path, _), name in zip(paths, names)
+			if len(inputs_by_name[name.lower()]) == 1
+		}
+		for future in as_completed(futures):
+			i += 1
+			path = futures[future]
+			done, elapsed, error = future.result()
+			if error is not None:
+				failed += 1
+				print("[%d/%d] FAILED %s (%.3f s)\n%s" % (i, len(paths), path, elapsed, error), file=sys.stderr)
+				continue
+			if done:
+				converted += 1
+				status = "done"
+			else:
+				skipped += 1
+				status = "up to date"
+			if not args.quiet:
+				print("[%d/%d] %s %s (%.3f s)" % (i, len(paths), status, path, elapsed))
+
+	print("%d converted, %d up to date, %d failed in %.3f s" % (converted, skipped, failed, time.perf_counter() - t))
+	return 1 if failed else 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
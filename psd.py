@@ -1,10 +1,21 @@
 # -*- coding: utf-8 -*-
 
+import os
+import stat
+import time
+import tempfile
+import contextlib
+import asyncio
+import hashlib
+import threading
+import zlib
 import png
 import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 np.set_printoptions(formatter={'int':hex})
 
-from buffer import Buffer
+from buffer import Buffer, FileBuffer, file_stat
 
 # A PngArray is a numpy.array describing an image in the pypng module conevntion
 # a w*h RGBA image is described as a (h, w*4) image, components are in ARGB order
@@ -13,40 +24,77 @@ write_version_info = True
 write_resolution_info = True
 write_unicode_layer_name = True
 
+# name of the records closing layer groups
+section_divider_name = "</Layer group>"
+
+# tagged blocks of layer records whose length is 8 bytes in PSB files
+psb_long_keys = ['LMsk', 'Lr16', 'Lr32', 'Layr', 'Mt16', 'Mt32', 'Mtrn', 'Alph', 'FMsk', 'lnk2', 'FEid', 'FXid', 'PxSD']
+
 
 def load_png(path):
 	r = png.Reader(path)
-	w, h, arr, info = r.read()
+	w, h, rows, info = r.asRGBA8()
 
-	arr = np.array(list(arr), dtype=np.uint8)
+	# rows are joined once, without going through python lists
+	arr = np.frombuffer(bytearray().join(rows), dtype=np.uint8)
 	arr.shape = (h, w*4)
 	
 	return arr
 
+def _load_png_channels(path):
+	# PsdFile.from_images worker: load a png, crop it to its non transparent
+	# pixels and split it in compact A, R, G, B planes
+	image = load_png(path)
+	top, left, bottom, right = get_bounding_box(image)
+	return (left, top), _to_planes(image[top : bottom, 4*left : 4*right])
+
+def _to_planes(image):
+	# PngArray in RGBA order as one contiguous (4, h, w) array of A, R, G, B
+	# planes
+	h, w = image.shape[0], image.shape[1] // 4
+	return np.ascontiguousarray(image.reshape(h, w, 4).transpose(2, 0, 1)[[3, 0, 1, 2]])
+
 def get_bounding_box(a):
-	array = a[:,:]
-	array.dtype = np.uint32
-	height, width = array.shape
-	top = 0
-	while top < height and not array[top, :].any():
-		top += 1
- 			
-	left = 0
-	while left < width and not array[:, left].any():
-		left += 1
- 			
-	bottom = height - 1
-	while bottom >= 0 and not array[bottom, :].any():
-		bottom -= 1
-	bottom += 1
-	
-	right = width - 1
-	while right >= 0 and not array[:, right].any():
-		right -= 1
-	right += 1
+	# bounding box (top, left, bottom, right) of the non transparent pixels
+	# of a PngArray in RGBA order (all zeros if the image is transparent)
+	# a is left untouched
+	return get_bounding_boxes([a])[0]
+
+def get_bounding_boxes(images):
+	# get_bounding_box for a list of PngArrays: images of the same shape
+	# are processed together
+	res = [None] * len(images)
+	by_shape = {}
+	for i, image in enumerate(images):
+		by_shape.setdefault(image.shape, []).append(i)
+
+	for (height, width4), indices in by_shape.items():
+		# (n, h, w) alpha channels
+		alpha = np.stack([images[i][:, 3::4] for i in indices])
+		rows = alpha.any(axis=2)
+		cols = alpha.any(axis=1)
+		tops = rows.argmax(axis=1)
+		bottoms = height - rows[:, ::-1].argmax(axis=1)
+		lefts = cols.argmax(axis=1)
+		rights = width4 // 4 - cols[:, ::-1].argmax(axis=1)
+		empty = ~rows.any(axis=1)
+
+		for j, i in enumerate(indices):
+			if empty[j]:
+				res[i] = (0, 0, 0, 0)
+			else:
+				res[i] = (int(tops[j]), int(lefts[j]), int(bottoms[j]), int(rights[j]))
+
+	return res
 
-	# print("get_bounding_box: top=%d left=%d bottom=%d right=%d" % (top, left, bottom, right))	
-	return top, left, bottom, right
+def trim_images(images):
+	# crop a list of PngArrays (RGBA order) to their non transparent pixels
+	# returns a list of (cropped image, bounding box in the original image)
+	res = []
+	for image, box in zip(images, get_bounding_boxes(images)):
+		top, left, bottom, right = box
+		res += [(image[top : bottom, 4*left : 4*right], box)]
+	return res
 
 def write_pascal_string(buf, s):
 	# Pascal String
@@ -61,10 +109,93 @@ def write_pascal_string(buf, s):
 		buf.write_b(0)
 		i += 1
 
-def write_offset(buf, offset_pos):
-	offset = buf.index - offset_pos - 4
-#	print("offset : from %X to %X = %X at %X" % (offset_pos + 4, buf.index, offset, offset_pos))
-	buf.write_l(offset, pos=offset_pos)
+def write_offset(buf, offset_pos, size=4):
+	# size: size of the length field, 4 or 8 (**PSB** section lengths)
+	offset = buf.index - offset_pos - size
+#	print("offset : from %X to %X = %X at %X" % (offset_pos + size, buf.index, offset, offset_pos))
+	if size == 8:
+		buf.write_q(offset, pos=offset_pos)
+	else:
+		buf.write_l(offset, pos=offset_pos)
+
+def write_length(buf, length, version=1, pos=-1):
+	# length field of 4 bytes, or 8 bytes in PSB files (version 2)
+	if version == 2:
+		buf.write_q(length, pos)
+	else:
+		buf.write_l(length, pos)
+
+def _depth_dtype(depth):
+	# native type of the channels of a file with depth bits per channel
+	if depth == 8:
+		return np.dtype(np.uint8)
+	elif depth == 16:
+		return np.dtype(np.uint16)
+	elif depth == 32:
+		return np.dtype(np.float32)
+	raise Exception("Unsupported depth: %d" % depth)
+
+def _file_dtype(depth):
+	# type of the channels samples as stored in files (big endian)
+	return _depth_dtype(depth).newbyteorder('>')
+
+def _max_value(dtype):
+	# value of an opaque alpha / full intensity component
+	if dtype.kind == 'f':
+		return 1.
+	return np.iinfo(dtype).max
+
+def _convert_depth(data, depth):
+	# data with the samples type of depth, converted only if needed
+	dtype = _depth_dtype(depth)
+	if data.dtype.kind == dtype.kind and data.dtype.itemsize == dtype.itemsize:
+		return data
+	values = data.astype(np.float32) * np.float32(1. / _max_value(data.dtype))
+	if dtype.kind == 'f':
+		return values
+	return (values.clip(0, 1) * _max_value(dtype) + .5).astype(dtype)
+
+def _to_file_bytes(data, depth):
+	# (h, w) channel as (h, w * bytes per sample) big endian bytes
+	h, w = data.shape
+	data = np.ascontiguousarray(_convert_depth(data, depth), dtype=_file_dtype(depth))
+	return data.view(np.uint8).reshape(h, w * data.itemsize)
+
+def _predict(data, depth):
+	# ZIP with prediction: each sample is replaced by its difference with
+	# the previous one in the row
+	# data: (h, w * bytes per sample) big endian bytes
+	# 32 bits rows are first split in byte planes (all high bytes first)
+	h = data.shape[0]
+	if depth == 16:
+		samples = data.view('>u2').astype(np.uint16)
+		res = samples.copy()
+		res[:, 1:] = np.diff(samples, axis=1)
+		return res.astype('>u2').view(np.uint8)
+	if depth == 32:
+		data = data.reshape(h, -1, 4).transpose(0, 2, 1).reshape(h, -1)
+	res = data.copy()
+	res[:, 1:] = np.diff(data, axis=1)
+	return res
+
+def _unpredict(data, depth):
+	# inverse of _predict, returns (h, w) samples
+	h = data.shape[0]
+	if depth == 16:
+		return np.cumsum(data.view('>u2'), axis=1, dtype=np.uint16)
+	res = np.cumsum(data, axis=1, dtype=np.uint8)
+	if depth == 32:
+		res = np.ascontiguousarray(res.reshape(h, 4, -1).transpose(0, 2, 1))
+		res = res.view('>f4').reshape(h, -1)
+	return res
+
+def _png_rows(image):
+	# PngArray of any depth, and the bit depth to write it with
+	if image.dtype.kind == 'f':
+		image = _convert_depth(image, 16)
+	if image.dtype.itemsize == 2:
+		return image.astype(np.uint16), 16
+	return image, 8
 
 def writeUTF16(buf, s):
 	# Unicode String
@@ -76,36 +207,400 @@ def writeUTF16(buf, s):
 	buf.write(data)
 	buf.write_w(0)
 
+def _pack_bits_rows(data):
+	# PackBits encoder for a block of rows, see _pack_bits
+	h, w = data.shape
+	flat = data.ravel()
+	n = len(flat)
+
+	# runs of identical bytes, never crossing a row boundary
+	is_run_start = np.empty(n, dtype=bool)
+	is_run_start[0] = True
+	np.not_equal(flat[1:], flat[:-1], out=is_run_start[1:])
+	is_run_start[::w] = True
+	run_starts = np.flatnonzero(is_run_start)
+	run_lens = np.diff(np.append(run_starts, n))
+	run_rows = run_starts // w
+	run_is_repeat = run_lens >= 3
+
+	# segments: a repeated run, or consecutive short runs merged as literals
+	is_seg_start = run_is_repeat.copy()
+	is_seg_start[0] = True
+	is_seg_start[1:] |= run_is_repeat[:-1]
+	is_seg_start[1:] |= run_rows[1:] != run_rows[:-1]
+	seg_runs = np.flatnonzero(is_seg_start)
+	seg_starts = run_starts[seg_runs]
+	seg_lens = np.add.reduceat(run_lens, seg_runs)
+	seg_is_repeat = run_is_repeat[seg_runs]
+	seg_rows = run_rows[seg_runs]
+
+	# packets: segments cut in chunks of at most 128 bytes
+	seg_nb_packets = (seg_lens + 127) // 128
+	pk_segs = np.repeat(np.arange(len(seg_runs)), seg_nb_packets)
+	pk_ranks = np.arange(len(pk_segs)) - np.repeat(np.cumsum(seg_nb_packets) - seg_nb_packets, seg_nb_packets)
+	pk_lens = np.minimum(128, seg_lens[pk_segs] - 128*pk_ranks)
+	pk_starts = seg_starts[pk_segs] + 128*pk_ranks
+	pk_is_repeat = seg_is_repeat[pk_segs] & (pk_lens >= 2)
+	pk_sizes = np.where(pk_is_repeat, 2, pk_lens + 1)
+	pk_pos = np.cumsum(pk_sizes) - pk_sizes
+
+	res = np.empty(int(pk_sizes.sum()), dtype=np.uint8)
+	is_literal = np.ones(len(res), dtype=bool)
+
+	# headers: n - 1 for n literal bytes, 257 - n for n repeated bytes
+	res[pk_pos] = np.where(pk_is_repeat, 257 - pk_lens, pk_lens - 1)
+	is_literal[pk_pos] = False
+
+	rep_pos = pk_pos[pk_is_repeat] + 1
+	res[rep_pos] = flat[pk_starts[pk_is_repeat]]
+	is_literal[rep_pos] = False
+
+	# literal packets cover the source and the output in the same order
+	res[is_literal] = flat[np.repeat(~pk_is_repeat, pk_lens)]
+
+	row_sizes = np.bincount(seg_rows[pk_segs], weights=pk_sizes, minlength=h).astype(np.intp)
+	return row_sizes, res
+
+def _pack_bits(data, block_size=0x400000):
+	# PackBits encoder working on whole channels
+	# data : (h, w) uint8 array, each row is encoded separately
+	# returns the byte count of each encoded row and the encoded rows
+	h, w = data.shape
+	if h == 0 or w == 0:
+		return np.zeros(h, dtype=np.intp), np.zeros(0, dtype=np.uint8)
+
+	# work on blocks of rows to keep the temporary index arrays small
+	block_h = max(1, block_size // w)
+	if block_h >= h:
+		return _pack_bits_rows(data)
+
+	row_sizes, packed = [], []
+	for y in range(0, h, block_h):
+		block_row_sizes, block_packed = _pack_bits_rows(data[y : y + block_h])
+		row_sizes += [block_row_sizes]
+		packed += [block_packed]
+	return np.concatenate(row_sizes), np.concatenate(packed)
+
+class PsdStats:
+	# opt-in instrumentation of load_psd and PsdFile.save: wall time, bytes
+	# read or written and pixels decoded or encoded, per section and per
+	# layer; callback(kind, entry) is called after each section ("section")
+	# and each layer ("layer")
+	# without a PsdStats object, the only cost is an "is not None" test per
+	# section and per layer
+	def __init__(self, callback=None):
+		self.callback = callback
+		# entries are dicts: name, time (seconds), bytes, pixels
+		self.sections = []
+		self.layers = []
+		self.start()
+
+	def start(self, pos=0):
+		# the next section starts now, at position pos
+		self.time = time.perf_counter()
+		self.pos = pos
+
+	def end_section(self, name, pos, pixels=0, size=None):
+		# the current section ends at pos (size bytes if given)
+		now = time.perf_counter()
+		entry = {"name": name, "time": now - self.time, "bytes": pos - self.pos if size is None else size, "pixels": pixels}
+		self.time, self.pos = now, pos
+		self.sections += [entry]
+		if self.callback is not None:
+			self.callback("section", entry)
+
+	def add_layer(self, name, elapsed, size, pixels):
+		# elapsed: None when the layer was not processed on its own
+		entry = {"name": name, "time": elapsed, "bytes": size, "pixels": pixels}
+		self.layers += [entry]
+		if self.callback is not None:
+			self.callback("layer", entry)
+
+	def get_section(self, name):
+		for entry in self.sections:
+			if entry["name"] == name:
+				return entry
+		raise Exception("Section [%s] not found" % name)
+
+	def __str__(self):
+		lines = []
+		for title, entries in (("sections", self.sections), ("layers", self.layers)):
+			lines += [title]
+			for entry in entries:
+				elapsed = "%8.3f s" % entry["time"] if entry["time"] is not None else " " * 10
+				lines += ["  %-24s %s %12d bytes %12d pixels" % (entry["name"], elapsed, entry["bytes"], entry["pixels"])]
+		return "\n".join(lines)
+
+class EncodedChannelCache:
+	# opt-in cache of encoded channel data, shared by saves (see
+	# PsdFile.save): channels with the same samples and encoding settings
+	# are encoded once
+	# entries are keyed by a hash of the samples (blake2b), their shape and
+	# the compression, version and depth; the least recently used ones are
+	# dropped beyond max_size bytes of encoded data
+	def __init__(self, max_size=0x10000000):
+		self.max_size = max_size
+		self.size = 0
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		# channels are encoded by several threads
+		self.lock = threading.Lock()
+
+	@staticmethod
+	def key(data, compression, version, depth):
+		# data: channel as (h, w * bytes per sample) big endian bytes
+		digest = hashlib.blake2b(np.ascontiguousarray(data), digest_size=16).digest()
+		return digest, data.shape, compression, version, depth
+
+	def get(self, key):
+		# compression actually used and encoded chunks, None if not cached
+		with self.lock:
+			encoded = self.entries.get(key)
+			if encoded is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			self.entries.move_to_end(key)
+			return encoded
+
+	def put(self, key, encoded):
+		size = sum(memoryview(chunk).nbytes for chunk in encoded[1])
+		if size > self.max_size:
+			return
+		with self.lock:
+			if key in self.entries:
+				return
+			self.entries[key] = encoded
+			self.size += size
+			while self.size > self.max_size:
+				_, (_, dropped) = self.entries.popitem(last=False)
+				self.size -= sum(memoryview(chunk).nbytes for chunk in dropped)
+				self.evictions += 1
+
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.size = 0
+
+	def hit_rate(self):
+		lookups = self.hits + self.misses
+		return self.hits / lookups if lookups else 0.
+
+	def __str__(self):
+		return "%d entries, %d bytes, %d hits, %d misses (%.1f%%), %d evictions" % (
+			len(self.entries), self.size, self.hits, self.misses, 100 * self.hit_rate(), self.evictions)
+
+def _encode(data, compression, version, depth):
+	# compression actually used and encoded chunks of a channel given as
+	# file bytes (see PsdChannel.encode)
+	if compression == 0:
+		return compression, [data]
+	elif compression == 1:
+		# h * 2 : byte counts for each row, followed by the PackBits rows
+		# (**PSB** h * 4)
+		row_sizes, packed = _pack_bits(data)
+		row_sizes_dtype = _row_sizes_dtype(version)
+		if len(row_sizes) and row_sizes.max() > np.iinfo(row_sizes_dtype).max:
+			# packed rows too long for their byte counts (32 bits rows of
+			# more than about 16000 pixels in PSD files): ZIP instead
+			return _encode(data, 3, version, depth)
+		return compression, [row_sizes.astype(row_sizes_dtype), packed]
+	elif compression == 2:
+		return compression, [zlib.compress(data)]
+	elif compression == 3:
+		return compression, [zlib.compress(_predict(data, depth))]
+	raise Exception("Unsupported compression: %d" % compression)
+
 class PsdChannel:
+	__slots__ = (
+		'id', '_data', 'width', 'height', 'size', 'compression', 'length',
+		'source', 'offset', 'source_length', 'version', 'depth', 'on_decode',
+		'modified', 'layer'
+	)
+
 	def __init__(self,
         id,
-		data
+		data = None,
+		compression = None,
+		size = None,
+		source = None,
+		offset = 0,
+		on_decode = None,
+		version = 1,
+		depth = 8,
+		source_length = None
 	):
+		# a channel is either built from a (h, w) array (data), or decoded
+		# on first access from a Buffer (source) where its compression flag
+		# and image data start at offset (source_length bytes)
 		self.id = id
-		self.data = data
-		self.height, self.width = data.shape
+		self._data = data
+		if data is not None:
+			if source is not None:
+				# decoded from the source: see the data property
+				data.flags.writeable = False
+			self.height, self.width = data.shape
+		else:
+			self.width, self.height = size
 		self.size = (self.width, self.height)
+		# compression used when writing this channel, None to use the file's one
+		self.compression = compression
+		# length of the channel data, as last written
+		self.length = None
+
+		self.source = source
+		self.offset = offset
+		self.source_length = source_length
+		# version of the source file: 1 = PSD, 2 = PSB
+		self.version = version
+		# bits per sample in the source file: 8, 16 or 32
+		self.depth = depth
+		# called with the channel each time it is decoded from its source
+		self.on_decode = on_decode
+		# data changed since it was read from the source
+		self.modified = False
+		# PsdLayer the channel belongs to, if any
+		self.layer = None
 		# print("Channel %d: size=(%s)" % (self.id, self.size))
+
+	@property
+	def data(self):
+		# data decoded from the source is read only, as unmodified channels
+		# are written by copying their source: to edit it, assign a modified
+		# copy (channel.data = channel.data.copy())
+		if self._data is None and self.source is not None:
+			# the source is kept alive by the channel anyway: no need to copy
+			self._data = _read_channel(self.source, self.width, self.height, self.offset, copy=False, version=self.version, depth=self.depth, length=self.source_length)
+			self._data.flags.writeable = False
+			if self.on_decode is not None:
+				self.on_decode(self)
+		return self._data
+
+	@data.setter
+	def data(self, data):
+		self._data = data
+		self.height, self.width = data.shape
+		self.size = (self.width, self.height)
+		self.modified = True
+
+	def is_pass_through(self, compression=None, version=1, depth=8):
+		# the channel data can be copied verbatim from its source: it is
+		# unmodified, and its source has the same depth and the compression
+		# wanted in the file written (the channel's own compression, else
+		# compression, None to keep the source one)
+		if self.source is None or self.modified or self.depth != depth or self.source_length is None:
+			return False
+		source_compression = self.source.read_w(self.offset)
+		if self.compression is not None:
+			compression = self.compression
+		if compression is not None and compression != source_compression:
+			return False
+		# RLE row byte counts are longs in PSB files
+		return self.version == version or source_compression != 1
+
+	def is_decoded(self):
+		return self._data is not None
+
+	def has_row_access(self):
+		# rows of the source can be read without decoding the rows above
+		# them (raw and RLE data, unlike ZIP streams), see read_region
+		return self.source is not None and self.source.read_w(self.offset) in (0, 1)
+
+	def read_region(self, top, left, bottom, right):
+		# (bottom - top, right - left) part of the channel, read from the
+		# source without decoding the whole channel if it is not decoded yet
+		if self._data is None and self.source is not None:
+			return _read_channel_region(self.source, self.width, self.height, self.offset, (top, left, bottom, right), version=self.version, depth=self.depth, length=self.source_length)
+		return self.data[top : bottom, left : right]
+
+	def evict(self):
+		# release the decoded data, it will be decoded again when needed
+		if self.source is not None:
+			self._data = None
+			# nor kept alive by the layer data
+			if self.layer is not None:
+				self.layer._data_cache = None
 	
-	def write_data(self, buf, compression=0):
-		# @TODO : write RLE compressed data
+	def encode(self, compression=0, version=1, depth=8, cache=None):
+		# compressed image data of the channel (what follows the compression
+		# flag), as a list of buffers
+		# returns the compression actually used and the buffers
+		# compression: 0 = Raw Data, 1 = RLE compressed, 2 = ZIP without
+		# prediction, 3 = ZIP with prediction
+		# version: 1 = PSD, 2 = PSB
+		# depth: bits per sample (data is converted if needed)
+		# cache: EncodedChannelCache to look the encoded data up in
+		if self.compression is not None:
+			compression = self.compression
+
+		# a channel decoded only to be written is released afterwards
+		was_decoded = self.is_decoded()
+		data = _to_file_bytes(self.data, depth)
+		if not was_decoded:
+			self.evict()
+		
+		# raw data is not worth caching
+		if cache is None or compression == 0:
+			return _encode(data, compression, version, depth)
+
+		key = cache.key(data, compression, version, depth)
+		encoded = cache.get(key)
+		if encoded is None:
+			encoded = _encode(data, compression, version, depth)
+			cache.put(key, encoded)
+		return encoded
+
+	def write_data(self, buf, compression=0, version=1, depth=8, encoded=None, cache=None, keep_compression=False):
+		# encoded: result of encode, if the channel is already encoded
+		# unmodified channels are copied from their source, if they have the
+		# requested compression or keep_compression is True
+		if encoded is None and self.is_pass_through(None if keep_compression else compression, version, depth):
+			buf.write_from(self.source, self.offset, self.source_length)
+			self.length = self.source_length
+			return
+
+		if encoded is None:
+			encoded = self.encode(compression, version, depth, cache)
+		compression, chunks = encoded
+
+		start = buf.index
 		buf.write_w(compression)
-		
-		if compression == 0:
-			buf.write(self.data.flatten())
+		for chunk in chunks:
+			buf.write(chunk)
+		self.length = buf.index - start
 	
 	def __len__(self):
-		return self.height * self.width + 2
+		if self.length is None:
+			return self.height * self.width * self.depth // 8 + 2
+		return self.length
 
 class PsdLayer():
+	__slots__ = (
+		'name', 'channels', 'offset', 'nb_channels', 'is_visible',
+		'opacity', 'size', 'color_mode', 'psd', 'section_type', 'layer_id',
+		'parent', 'children', 'divider', 'channel_length_pos', '_data_cache',
+		'_below', '_above'
+	)
+
 	def __init__(self, 
 		name = '', 
 		offset = (0, 0),
 		size=None,
 		surface  = None,
 		channels = [],
-		image = None
+		image = None,
+		opacity = 255,
+		is_visible = True,
+		section_type = 0,
+		layer_id = None,
+		planes = None
 	):
+		# the pixels are given as channels (list of PsdChannel), as an image
+		# (PngArray in RGBA order, cropped to its non transparent pixels) or
+		# as planes (one (4, h, w) array of A, R, G, B planes, the channels
+		# are then contiguous views of it)
 		# print("PsdLayer")
 		self.name = name
 
@@ -113,23 +608,27 @@ class PsdLayer():
 			top, left, bottom, right = get_bounding_box(image)
 			x0, y0 = offset
 			offset = (x0 + left, y0 + top)
+			planes = _to_planes(image[top : bottom, 4*left : 4*right])
 
-			cropped_image = image[top : bottom, 4*left : 4*right]				
-			self.channels = [
-				PsdChannel(-1, cropped_image[:, 3::4]),
-				PsdChannel(0, cropped_image[:, 2::4]),
-				PsdChannel(1, cropped_image[:, 1::4]),
-				PsdChannel(2, cropped_image[:, 0::4])
-			]
-			
-			size = (right - left, bottom - top)
+		if planes is not None:
+			self.channels = [PsdChannel(j - 1, plane) for j, plane in enumerate(planes)]
+			size = (planes.shape[2], planes.shape[1])
+
+		elif not channels and section_type:
+			# groups have no pixels
+			self.channels = [PsdChannel(j - 1, np.zeros((0, 0), dtype=np.uint8)) for j in range(4)]
+			size = (0, 0)
 
 		else:
 			self.channels = channels
+		for channel in self.channels:
+			channel.layer = self
 
 		self.offset = offset
 		self.nb_channels = len(self.channels)
-		self.is_visible = True
+		self.is_visible = is_visible
+		# 0 = transparent ... 255 = opaque
+		self.opacity = opacity
 		
 		if size is None:
 			w, h = self.channels[0].size
@@ -138,32 +637,140 @@ class PsdLayer():
 			self.size = size
 
 		self.color_mode = 3
+		# PsdFile the layer belongs to
+		self.psd = None
+
+		# 0 = any other type of layer, 1 = open folder, 2 = closed folder,
+		# 3 = bounding section divider (closing a folder)
+		self.section_type = section_type
+		# unique identifier in the PsdFile (set when added if None)
+		self.layer_id = layer_id
+		# group containing the layer, None at the top level
+		self.parent = None
+		# for groups: layers of the group (bottom to top, as the keys of a
+		# dict: removed in constant time), and divider record
+		self.children = {}
+		self.divider = None
+		# records below and above in the PsdFile (see PsdFile.layers)
+		self._below = self._above = None
+		# offsets of the channel lengths in the layer record, as last written
+		self.channel_length_pos = []
+		# last result of get_data(copy=False): order, channel arrays, result
+		self._data_cache = None
 		# print("""Layer "%s": size=%s, offset=%s""" % (self.name, self.size, self.offset))
 
+	def evict(self):
+		# release the decoded channels and the data built from them
+		for channel in self.channels:
+			channel.evict()
+		self._data_cache = None
+
+	def is_group(self):
+		return self.section_type in (1, 2)
+
+	def iter_descendants(self):
+		# layers of a group and of its sub groups
+		for child in self.children:
+			yield child
+			for descendant in child.iter_descendants():
+				yield descendant
+
+	def get_path(self):
+		# names of the groups containing the layer and of the layer, joined by '/'
+		if self.parent is None:
+			return self.name
+		return self.parent.get_path() + '/' + self.name
+
+	def is_displayed(self):
+		# visible, and in visible groups
+		layer = self
+		while layer is not None:
+			if not layer.is_visible:
+				return False
+			layer = layer.parent
+		return True
+
+	def rename(self, name):
+		if self.psd is not None:
+			self.psd._unindex(self)
+		self.name = name
+		if self.psd is not None:
+			self.psd._index(self)
+
+	def invalidate(self):
+		# the layer appearance changed: its area of the merged image must
+		# be composited again
+		self._data_cache = None
+		if self.psd is not None:
+			if self.is_group():
+				for layer in self.iter_descendants():
+					self.psd.invalidate(layer.get_bounding_box())
+			else:
+				self.psd.invalidate(self.get_bounding_box())
+
 	def hide(self):
 		self.is_visible = False
+		self.invalidate()
 	
 	def show(self):
 		self.is_visible = True
+		self.invalidate()
+
+	def set_opacity(self, opacity):
+		self.opacity = opacity
+		self.invalidate()
 		
-	def get_data(self, order="ARGB"):
+	def get_data(self, order="ARGB", copy=True):
 		# return data as a PngArray (order can be modified)
+		# without copy, the result is read only and shared by the next calls
+		# (with the same order) until the channels change
+
+		arrays = [channel.data for channel in self.channels]
+		if not copy and self._data_cache is not None:
+			cached_order, cached_arrays, res = self._data_cache
+			if cached_order == order and len(cached_arrays) == len(arrays) and all(a is b for a, b in zip(cached_arrays, arrays)):
+				return res
 
 		w, h = self.size
-		res = np.zeros((h, w, 4), dtype = np.uint8)
+		dtype = np.dtype(arrays[0].dtype.type) if arrays else np.uint8
+		res = np.empty((h, w, 4), dtype = dtype) if len(arrays) == 4 else np.zeros((h, w, 4), dtype = dtype)
 		
-		res[:,:,order.index("A")] = self.channels[0].data # A
-		res[:,:,order.index("R")] = self.channels[1].data # R
-		res[:,:,order.index("G")] = self.channels[2].data # G
-		res[:,:,order.index("B")] = self.channels[3].data # B
+		for c, data in zip("ARGB", arrays):
+			res[:,:,order.index(c)] = data
 		
 		res.shape = (h, w*4)
 
+		if not copy:
+			res.flags.writeable = False
+			self._data_cache = (order, arrays, res)
+		return res
+
+	def read_region(self, top, left, bottom, right, order="ARGB"):
+		# rectangle (top, left, bottom, right) of the canvas, as a PngArray;
+		# only the needed part of the channels is read, transparent outside
+		# of the layer
+		w, h = self.size
+		l_top, l_left, l_bottom, l_right = self.get_bounding_box()
+		if not self.channels:
+			dtype = np.uint8
+		elif self.channels[0].is_decoded():
+			dtype = np.dtype(self.channels[0].data.dtype.type)
+		else:
+			dtype = _depth_dtype(self.channels[0].depth)
+		res = np.zeros((bottom - top, right - left, 4), dtype = dtype)
+
+		y0, x0 = max(top, l_top), max(left, l_left)
+		y1, x1 = min(bottom, l_bottom), min(right, l_right)
+		if y0 < y1 and x0 < x1:
+			for c, channel in zip("ARGB", self.channels):
+				res[y0 - top : y1 - top, x0 - left : x1 - left, order.index(c)] = channel.read_region(y0 - l_top, x0 - l_left, y1 - l_top, x1 - l_left)
+
+		res.shape = (bottom - top, (right - left)*4)
 		return res
 
 	def save_as_png(self, path, crop=False):
-		layer_data = self.get_data(order = "RGBA")
-		png.from_array(layer_data, mode="RGBA").save(path)
+		layer_data, bitdepth = _png_rows(self.get_data(order = "RGBA", copy = False))
+		png.from_array(layer_data, mode="RGBA;%d" % bitdepth).save(path)
 		
 	def get_bounding_box(self):
 		left, top = self.offset
@@ -176,7 +783,7 @@ class PsdLayer():
 # 			print(a.shape, channel.data.shape)
 # 			a[i,:h,:w] = channel.data[:]
 
-	def write_to_buffer(self, buf):		
+	def write_to_buffer(self, buf, version=1):		
 		# 4 * 4 : Rectangle containing the contents of the layer. Specified as top, left, bottom, right coordinates
 		top, left, bottom, right = self.get_bounding_box()
 		buf.write_l(top)
@@ -188,22 +795,25 @@ class PsdLayer():
 		buf.write_w(self.nb_channels)
 		
 		# 6 * number of channels : Channel information. 
+		self.channel_length_pos = []
 		for channel in self.channels:			
 			# 2 bytes for Channel ID: 0 = red, 1 = green, etc.;
 			buf.write_w(channel.id, signed=True)
 					
 			# 4 bytes for length of corresponding channel data. (**PSB** 8 bytes for length of corresponding channel data.) See See Channel image data for structure of channel data.
-			buf.write_l(len(channel))
+			# (patched once the channel data is written)
+			self.channel_length_pos += [buf.index]
+			write_length(buf, len(channel), version)
 					
 		# 4 : Blend mode signature: '8BIM'
 		buf.write_string("8BIM")
 		
 		# 4 : Blend mode key:		
 		# 'pass' = pass through, 'norm' = normal, 'diss' = dissolve, 'dark' = darken, 'mul ' = multiply, 'idiv' = color burn, 'lbrn' = linear burn, 'dkCl' = darker color, 'lite' = lighten, 'scrn' = screen, 'div ' = color dodge, 'lddg' = linear dodge, 'lgCl' = lighter color, 'over' = overlay, 'sLit' = soft light, 'hLit' = hard light, 'vLit' = vivid light, 'lLit' = linear light, 'pLit' = pin light, 'hMix' = hard mix, 'diff' = difference, 'smud' = exclusion, 'fsub' = subtract, 'fdiv' = divide 'hue ' = hue, 'sat ' = saturation, 'colr' = color, 'lum ' = luminosity
-		buf.write_string("norm")
+		buf.write_string("pass" if self.is_group() else "norm")
 		
 		# 1 : Opacity. 0 = transparent ... 255 = opaque
-		buf.write_b(255)
+		buf.write_b(self.opacity)
 
 		# 1 : Clipping: 0 = base, 1 = non-base
 		buf.write_b(0)
@@ -214,7 +824,8 @@ class PsdLayer():
 		# 	bit 2 = obsolete;
 		# 	bit 3 = 1 for Photoshop 5.0 and later, tells if bit 4 has useful information;
 		# 	bit 4 = pixel data irrelevant to appearance of document
-		buf.write_b(0)
+		# (bit 1 is actually set for hidden layers)
+		buf.write_b(0 if self.is_visible else 2)
 		
 		# 1 : Filler (zero)
 		buf.write_b(0)
@@ -245,11 +856,46 @@ class PsdLayer():
 			writeUTF16(buf, self.name)
 			write_offset(buf, extra_data_field_length_pos)
 
+		if self.section_type:
+			# Section divider setting
+			buf.write_string("8BIM")
+			buf.write_string("lsct")
+			if self.is_group():
+				buf.write_l(12)
+				buf.write_l(self.section_type)
+				# blend mode of the group
+				buf.write_string("8BIM")
+				buf.write_string("pass")
+			else:
+				buf.write_l(4)
+				buf.write_l(self.section_type)
+
+		if self.layer_id is not None:
+			# Layer ID
+			buf.write_string("8BIM")
+			buf.write_string("lyid")
+			buf.write_l(4)
+			buf.write_l(self.layer_id)
+
 		write_offset(buf, extra_data_field_length_pos_1)
 		
-	def write_channels_data_to_buffer(self, buf, compression=0):
-		for channel in self.channels:
-			channel.write_data(buf, compression)
+	def write_channels_data_to_buffer(self, buf, compression=0, version=1, depth=8, executor=None, cache=None, keep_compression=False):
+		# executor: if given, the channels are encoded in parallel by its
+		# workers (numpy and zlib release the GIL), then written in order
+		# cache: EncodedChannelCache reused by the channels
+		# keep_compression: unmodified channels keep the compression of their
+		# source (see PsdChannel.write_data)
+		pass_through_compression = None if keep_compression else compression
+		if executor is not None:
+			encoded = list(executor.map(
+				lambda channel: None if channel.is_pass_through(pass_through_compression, version, depth) else channel.encode(compression, version, depth, cache),
+				self.channels))
+		else:
+			encoded = [None] * len(self.channels)
+
+		for channel, length_pos, channel_encoded in zip(self.channels, self.channel_length_pos, encoded):
+			channel.write_data(buf, compression, version, depth, channel_encoded, cache, keep_compression)
+			write_length(buf, len(channel), version, pos=length_pos)
 
 		
 class PsdFile():
@@ -257,22 +903,211 @@ class PsdFile():
 		size = (0, 0), 
 		layers = [],
 		color_mode = 3,
-		palette = None
+		palette = None,
+		compression = 1,
+		version = 1,
+		depth = 8
 	):
 		self.size = size
+		# layer records, from bottom to top (see the layers property)
 		self.layers = layers
-		self.nb_layers = len(layers)
 		self.color_mode = color_mode
 		self.palette = palette		
+		# compression of the saved image data: 0 = Raw Data, 1 = RLE compressed
+		self.compression = compression
+		# 1 = PSD, 2 = PSB (Large Document Format), used anyway for
+		# documents larger than 30000 pixels
+		self.version = version
+		# bits per channel: 8, 16 or 32 (float samples)
+		self.depth = depth
+
+		# top level layers and groups (bottom to top, as the keys of a dict),
+		# each group holding its children
+		self.children = {}
+		# indexes of the layers (not the section dividers): by name (lists
+		# of layers, bottom to top), by path and by layer_id
+		self.layers_by_name = {}
+		self.layers_by_path = {}
+		self.layers_by_id = {}
+		self.next_layer_id = 1
+		self._build_tree()
+
+		# Image Data section of the file the layers were loaded from, copied
+		# verbatim when saving if no layer changed since: (source Buffer,
+		# position, length, version, depth, size), set by load_psd
+		self.merged_source = None
+
+		# merged image kept between calls to get_fusioned_image, as a
+		# (h, w, 4) RGBA array, and the rectangles to composite again
+		self.cache_composite = True
+		self.composite_cache = None
+		self.dirty_rects = []
+		# get_fusioned_image calls served from the cache as is (hits), after
+		# compositing the dirty rectangles (updates), or from scratch (misses)
+		self.cache_hits = self.cache_updates = self.cache_misses = 0
 	
-	def add_layer(self, layer):
+	@property
+	def layers(self):
+		# the records are linked to their neighbours, so that records are
+		# inserted and removed in constant time; the list is built again on
+		# first access after a change
+		if self._layers is None:
+			self._layers = []
+			record = self._bottom
+			while record is not None:
+				self._layers.append(record)
+				record = record._above
+		return self._layers
+
+	@layers.setter
+	def layers(self, layers):
+		self._bottom = self._top = None
+		self._layers = []
+		self.nb_layers = 0
+		self._link(list(layers))
+
+	def _link(self, records, above=None):
+		# insert records (bottom to top) below the record above, or on top
+		if not records:
+			return
+		below = self._top if above is None else above._below
+		for record in records:
+			record._below = below
+			if below is None:
+				self._bottom = record
+			else:
+				below._above = record
+			below = record
+		below._above = above
+		if above is None:
+			self._top = below
+			if self._layers is not None:
+				self._layers += records
+		else:
+			above._below = below
+			self._layers = None
+		self.nb_layers += len(records)
+
+	def _unlink(self, records):
+		# remove records, consecutive records from bottom to top
+		below, above = records[0]._below, records[-1]._above
+		if below is None:
+			self._bottom = above
+		else:
+			below._above = above
+		if above is None:
+			self._top = below
+		else:
+			above._below = below
+		for record in records:
+			record._below = record._above = None
+		self._layers = None
+		self.nb_layers -= len(records)
+
+	def _build_tree(self):
+		# groups are stored as: section divider, layers of the group, group
+		# record (from bottom to top)
+		stack = [([], None)]
+		for layer in self.layers:
+			layer.psd = self
+			if layer.section_type == 3:
+				stack.append(([], layer))
+			elif layer.is_group() and len(stack) > 1:
+				children, divider = stack.pop()
+				layer.children = dict.fromkeys(children)
+				layer.divider = divider
+				for child in children:
+					child.parent = layer
+				stack[-1][0].append(layer)
+			else:
+				stack[-1][0].append(layer)
+
+		# unclosed groups: their layers stay at the top level
+		while len(stack) > 1:
+			children, divider = stack.pop()
+			stack[0][0].extend([divider] + children)
+		self.children = dict.fromkeys(stack[0][0])
+
+		for layer in self.layers:
+			if layer.layer_id is not None:
+				self.next_layer_id = max(self.next_layer_id, layer.layer_id + 1)
+		for layer in self.layers:
+			if layer.layer_id is None:
+				layer.layer_id = self.next_layer_id
+				self.next_layer_id += 1
+		# groups index their content
+		for layer in self.children:
+			self._index(layer)
+
+	def _index(self, layer):
+		# add a layer, and the layers of a group (first, as they are below
+		# it), to the indexes
+		if layer.section_type == 3:
+			return
+		for child in layer.children:
+			self._index(child)
+		self.layers_by_name.setdefault(layer.name, []).append(layer)
+		self.layers_by_path.setdefault(layer.get_path(), layer)
+		self.layers_by_id[layer.layer_id] = layer
+
+	def _unindex(self, layer):
+		if layer.section_type == 3:
+			return
+		self.layers_by_name[layer.name].remove(layer)
+		if not self.layers_by_name[layer.name]:
+			del self.layers_by_name[layer.name]
+		if self.layers_by_path.get(layer.get_path()) is layer:
+			del self.layers_by_path[layer.get_path()]
+		self.layers_by_id.pop(layer.layer_id, None)
+		for child in layer.children:
+			self._unindex(child)
+
+	def _records(self, layer):
+		# layer records of a layer, or of a group and its content
+		if not layer.is_group():
+			return [layer]
+		if layer.divider is None:
+			layer.divider = PsdLayer(section_divider_name, section_type=3)
+		res = [layer.divider]
+		for child in layer.children:
+			res += self._records(child)
+		return res + [layer]
+
+	def add_group(self, name, parent=None, is_open=True):
+		# add an empty group, to be filled with add_layer(layer, parent=group)
+		group = PsdLayer(name, section_type=1 if is_open else 2)
+		self.add_layer(group, parent)
+		return group
+
+	def add_layer(self, layer, parent=None):
+		# add a layer (or a group with its content) on top of the others, or
+		# on top of the layers of the group parent
 		# print("PsdFile.add_layer")
 		assert type(layer) == PsdLayer
 		
-		self.layers.append(layer)
-		self.nb_layers += 1
-		
+		records = self._records(layer)
+		if parent is None:
+			self._link(records)
+			self.children[layer] = None
+		else:
+			# below the group record
+			self._link(records, parent)
+			parent.children[layer] = None
+		layer.parent = parent
+
+		for record in records:
+			record.psd = self
+			if record.layer_id is None or record.layer_id in self.layers_by_id:
+				record.layer_id = self.next_layer_id
+			self.next_layer_id = max(self.next_layer_id, record.layer_id + 1)
+		self._index(layer)
+		
+		if layer.is_group():
+			layer.invalidate()
+			return layer
+
 		top, left, bottom, right = layer.get_bounding_box()
+		self.invalidate((top, left, bottom, right))
 		
 		width, height = self.size
 
@@ -286,34 +1121,115 @@ class PsdFile():
 		
 		if top < 0 or right < 0:
 			print("Warning: lost data in layer [%s]" % layer.name)
+
+		return layer
 			
 	def remove_layer(self, layer):
-		self.layers.remove(layer)
-		self.nb_layers -= 1
+		# remove a layer, or a group with its content
+		layer.invalidate()
+		self._unindex(layer)
+
+		records = self._records(layer)
+		self._unlink(records)
+
+		if layer.parent is None:
+			del self.children[layer]
+		else:
+			del layer.parent.children[layer]
+		layer.parent = None
+		for record in records:
+			record.psd = None
+
+	def invalidate(self, rect=None):
+		# mark the rectangle rect (top, left, bottom, right) of the merged
+		# image as to be composited again, or the whole image if rect is None
+		# (to be called after modifying layers data directly)
+		# the merged image of the source file is outdated
+		self.merged_source = None
+		if rect is None:
+			self.composite_cache = None
+			self.dirty_rects = []
+		elif self.composite_cache is not None:
+			self.dirty_rects += [rect]
 		
 	def get_by_name(self, name):
-		for layer in self.layers:
-			if layer.name == name:
-				return layer
+		# lowest layer (or group) named name
+		if name in self.layers_by_name:
+			return self.layers_by_name[name][0]
 		raise Exception("Layer [%s] not found" % name)
 
+	def get_by_path(self, path):
+		# layer from its path, e.g. "Characters/Hero/Shadow"
+		if path in self.layers_by_path:
+			return self.layers_by_path[path]
+		raise Exception("Layer [%s] not found" % path)
+
+	def get_by_id(self, layer_id):
+		if layer_id in self.layers_by_id:
+			return self.layers_by_id[layer_id]
+		raise Exception("Layer #%d not found" % layer_id)
+
+	def iter_displayed_layers(self, layers=None):
+		# visible layers with pixels, from bottom to top; hidden groups are
+		# skipped with all their content
+		if layers is None:
+			layers = self.children
+		for layer in layers:
+			if not layer.is_visible:
+				continue
+			if layer.is_group():
+				for child in self.iter_displayed_layers(layer.children):
+					yield child
+			elif layer.section_type == 0:
+				yield layer
+
 	@staticmethod
-	def from_images(images):
+	def from_images(images, workers=None):
+		# one layer per png file, in the order of images
+		# the files are decoded in a pool of workers processes (None for the
+		# default number, 1 to decode them in this process)
 		res = PsdFile()
 		
-		for path in images:
-			image = load_png(path)
-			res.add_layer(PsdLayer(name=path, image=image))
+		if workers == 1 or len(images) <= 1:
+			loaded = map(_load_png_channels, images)
+		else:
+			with ProcessPoolExecutor(workers) as executor:
+				chunksize = max(1, len(images) // (4 * (workers or os.cpu_count() or 1)))
+				loaded = list(executor.map(_load_png_channels, images, chunksize=chunksize))
+
+		for path, (offset, planes) in zip(images, loaded):
+			res.add_layer(PsdLayer(name=path, offset=offset, planes=planes))
 		
 		return res
 			
-	def save(self, path):
-		buf = Buffer()
-		self.write_to_buffer(buf)
-		buf.index = 0
-		buf.save(path)
+	def save(self, path, compression=None, workers=None, stats=None, cache=None):
+		# sections are streamed to the file, their lengths patched in place
+		# (the file replaces path once written, see _replacing)
+		with _replacing(path) as f:
+			self.write_to_buffer(FileBuffer(f), compression, workers, stats, cache)
 	
-	def write_to_buffer(self, buf):
+	def write_to_buffer(self, buf, compression=None, workers=None, stats=None, cache=None):
+		# compression: 0 = Raw Data, 1 = RLE compressed, 2 = ZIP without
+		# prediction, 3 = ZIP with prediction (None for self.compression,
+		# unmodified data loaded from a file then keeps its compression)
+		# workers: number of threads encoding the channels of each layer in
+		# parallel, None to encode them serially
+		# stats: PsdStats collecting the timings of the sections
+		# cache: EncodedChannelCache, to reuse the layer channels encoded by
+		# previous saves
+		keep_compression = compression is None
+		if compression is None:
+			compression = self.compression
+		if stats is not None:
+			stats.start(buf.index)
+
+		width, height = self.size
+		version = self.version
+		if max(width, height) > 30000:
+			version = 2
+		# size of the section lengths
+		length_size = 4 * version
+
 		# =================================================================
 		# File Header Section
 		# =================================================================
@@ -322,7 +1238,7 @@ class PsdFile():
 		buf.write_string("8BPS")
 	
 		# 	Version (2) : always equal to 1. Do not try to read the file if the version does not match this value. (**PSB** version is 2.)
-		buf.write_w(1)
+		buf.write_w(version)
 		
 		# 	Reserved (6) : must be zero.
 		buf.write("00 00 00 00 00 00")
@@ -333,15 +1249,14 @@ class PsdFile():
 		elif self.color_mode == 3:
 			buf.write_w(4)
 
-		width, height = self.size
-		# 	The height of the image in pixels (4). Supported range is 1 to 30,000.
+		# 	The height of the image in pixels (4). Supported range is 1 to 30,000. (**PSB** max of 300,000.)
 		buf.write_l(height)
 		
-		# 	The width of the image in pixels (4). Supported range is 1 to 30,000.
+		# 	The width of the image in pixels (4). Supported range is 1 to 30,000. (**PSB** max of 300,000)
 		buf.write_l(width)
 		
 		# 	Depth (2) : the number of bits per channel. Supported values are 1, 8, 16 and 32.
-		buf.write_w(8)
+		buf.write_w(self.depth)
 		
 		# 	The color mode of the file (2). Supported values are: Bitmap = 0; Grayscale = 1; Indexed = 2; RGB = 3; CMYK = 4; Multichannel = 7; Duotone = 8; Lab = 9.
 		buf.write_w(self.color_mode)
@@ -361,6 +1276,8 @@ class PsdFile():
 			raise Exception("Indexed colors : not yet implemented")
 		
 		write_offset(buf, color_mode_data_section_pos)
+		if stats is not None:
+			stats.end_section("header", buf.index)
 
 
 		# =================================================================
@@ -414,6 +1331,8 @@ class PsdFile():
 			buf.align(2)
 		
 		write_offset(buf, image_resources_section_pos)
+		if stats is not None:
+			stats.end_section("image_resources", buf.index)
 		
 	
 		# =================================================================
@@ -421,14 +1340,14 @@ class PsdFile():
 		# =================================================================
 
 		layer_and_mask_information_section_length_pos = buf.index
-		# Length (4)
-		buf.write_l(0)
+		# Length (4) (**PSB** length is 8 bytes.)
+		write_length(buf, 0, version)
 		
 		# Layer info Section(s ?)
 		layer_info_offset = buf.index
 
 		# 4 : Length of the layers info section, rounded up to a multiple of 2. (**PSB** length is 8 bytes.)
-		buf.write_l(0)
+		write_length(buf, 0, version)
 		
 		# 2 : Layer count. If it is a negative number, its absolute value is the number of layers and the first alpha channel contains the transparency data for the merged result.
 		buf.write_w(len(self.layers))
@@ -437,101 +1356,531 @@ class PsdFile():
 		
 		# Layer records
 		for layer in self.layers:
-			layer.write_to_buffer(buf)			
+			layer.write_to_buffer(buf, version)			
+		if stats is not None:
+			stats.end_section("layer_records", buf.index)
 		
 		
 
 		# Channel image data. Contains one or more image data records
+		executor = ThreadPoolExecutor(workers) if workers is not None else None
 		for layer in self.layers:
-			layer.write_channels_data_to_buffer(buf) 
+			if stats is not None:
+				layer_start, layer_time = buf.index, time.perf_counter()
+			layer.write_channels_data_to_buffer(buf, compression, version, self.depth, executor, cache, keep_compression)
+			if stats is not None:
+				stats.add_layer(layer.name, time.perf_counter() - layer_time, buf.index - layer_start, layer.size[0] * layer.size[1])
+		if executor is not None:
+			executor.shutdown()
 
 		buf.write_w(0)
-		write_offset(buf, layer_info_offset)
+		write_offset(buf, layer_info_offset, length_size)
 		# Variable
 		
 		buf.write_l(0)
-		write_offset(buf, layer_and_mask_information_section_length_pos)
+		write_offset(buf, layer_and_mask_information_section_length_pos, length_size)
+		if stats is not None:
+			stats.end_section("channel_data", buf.index, sum(layer.size[0] * layer.size[1] for layer in self.layers))
 
-		buf.write_w(0)
-		fusion_channels = self.get_fusioned_image()
-		buf.write(fusion_channels.flatten())
+		# =================================================================
+		# Image Data Section
+		# =================================================================
 
-	def get_fusioned_image(self, order="ARGB"):
+		# planar R, G, B, A data of the merged image
+		merged_source = self.merged_source
+		if (merged_source is not None and merged_source[3:] == (version, self.depth, self.size)
+			and (keep_compression or merged_source[0].read_w(merged_source[1]) == compression)
+			and not any(channel.modified for layer in self.layers for channel in layer.channels)):
+			# no layer changed since loaded
+			buf.write_from(*merged_source[:3])
+		elif version == 1:
+			fusion = self.get_fusioned_image("RGBA", copy=False)
+			if stats is not None:
+				stats.end_section("composite", buf.index, width * height)
+			fusion.shape = (height, width, 4)
+			fusion_channels = PsdChannel(0, fusion.transpose(2, 0, 1).reshape(4*height, width))
+			fusion_channels.write_data(buf, compression, version, self.depth)
+		else:
+			# composited while written
+			self._write_fusion_by_bands(buf, compression, version)
+		if stats is not None:
+			stats.end_section("image_data", buf.index, width * height)
+
+	def _write_fusion_by_bands(self, buf, compression, version):
+		# image data section written without compositing the whole image at
+		# once: each band is composited once, its red component is written,
+		# and the green, blue and alpha ones are spooled to temporary files
+		# copied after the red one
+		width, height = self.size
+		buf.write_w(compression)
+		if compression == 1:
+			# byte counts of all rows, patched once all rows are written
+			row_sizes_pos = buf.index
+			row_sizes_dtype = _row_sizes_dtype(version)
+			buf.write(np.zeros(4*height, dtype=row_sizes_dtype))
+			row_sizes = [[] for k in range(4)]
+		elif compression in (2, 3):
+			# a single zlib stream for all components
+			compressor = zlib.compressobj()
+		elif compression != 0:
+			raise Exception("Unsupported compression: %d" % compression)
+
+		def write(data):
+			if compression in (2, 3):
+				data = compressor.compress(data)
+			buf.write(data)
+
+		spools = [tempfile.SpooledTemporaryFile(0x4000000) for k in range(3)]
+		try:
+			for band in self.iter_fusioned_bands("RGBA"):
+				for k in range(4):
+					plane = _to_file_bytes(band[:, k::4], self.depth)
+					if compression == 1:
+						band_row_sizes, plane = _pack_bits(plane)
+						row_sizes[k] += [band_row_sizes]
+					elif compression == 3:
+						plane = _predict(plane, self.depth)
+					if k == 0:
+						write(plane)
+					else:
+						spools[k - 1].write(plane)
+
+			for spool in spools:
+				spool.seek(0)
+				for chunk in iter(lambda: spool.read(0x100000), b""):
+					write(chunk)
+		finally:
+			for spool in spools:
+				spool.close()
+
+		if compression == 1:
+			buf.write(np.concatenate([sizes for component in row_sizes for sizes in component]).astype(row_sizes_dtype), row_sizes_pos)
+		elif compression in (2, 3):
+			buf.write(compressor.flush())
+
+	def get_fusioned_image(self, order="ARGB", tile_size=256, workers=None, copy=True):
+		# merged image of the visible layers, as a PngArray
+		# the canvas is composited by tiles of tile_size * tile_size pixels,
+		# in a pool of workers threads (None for the default number)
+		# without copy, the RGBA merged image is a read only view of the
+		# composite cache, updated with it
 		total_width, total_height = self.size
+		dtype = _depth_dtype(self.depth)
+
+		if not self.cache_composite:
+			res = np.zeros((total_height, total_width*4), dtype=dtype)
+			self._composite(res.reshape(total_height, total_width, 4), (0, 0, total_height, total_width), order, tile_size, workers)
+			return res
+
+		cache = self.composite_cache
+		if cache is None or cache.shape != (total_height, total_width, 4) or cache.dtype != dtype:
+			self.cache_misses += 1
+			cache = np.zeros((total_height, total_width, 4), dtype=dtype)
+			self._composite(cache, (0, 0, total_height, total_width), "RGBA", tile_size, workers)
+			self.composite_cache = cache
+		elif self.dirty_rects:
+			self.cache_updates += 1
+			for top, left, bottom, right in self.dirty_rects:
+				top, left = max(top, 0), max(left, 0)
+				bottom, right = min(bottom, total_height), min(right, total_width)
+				if top < bottom and left < right:
+					region = cache[top : bottom, left : right]
+					region[:] = 0
+					self._composite(region, (top, left, bottom, right), "RGBA", tile_size, workers)
+		else:
+			self.cache_hits += 1
+		self.dirty_rects = []
+
+		if not copy and order == "RGBA":
+			res = cache.reshape(total_height, total_width*4)
+			res.flags.writeable = False
+			return res
+
+		res = np.empty((total_height, total_width*4), dtype=dtype)
+		res3 = res.reshape(total_height, total_width, 4)
+		for i, c in enumerate("RGBA"):
+			res3[:, :, order.index(c)] = cache[:, :, i]
+		return res
 
-		# res: (total_height, total_width) uint32 RGBA
-		res = np.zeros((total_height, total_width), dtype=np.uint32)
-
-		alpha_bits = 0xFF << (8*order.index("A"))		
-		for layer in self.layers:
-			# print("processing layer: [%s]" % layer.name)
-			if layer.is_visible:
-				top, left, bottom, right = layer.get_bounding_box()
-	
-				# layer_data: shape=(h, w), uint32 ARGB
-				layer_data = layer.get_data(order=order).copy()
-				layer_data.dtype = np.uint32
-	
-				mask = (layer_data & alpha_bits) != 0
-				res[top:bottom, left:right][mask] = layer_data[mask]
-					
-		res.dtype = np.uint8
+	def read_composite_region(self, top, left, bottom, right, order="ARGB"):
+		# rectangle (top, left, bottom, right) of the merged image, as a
+		# PngArray: only the needed part of the layers is read
+		dtype = _depth_dtype(self.depth)
+		cache = self.composite_cache
+		if cache is not None and not self.dirty_rects and cache.shape == (self.size[1], self.size[0], 4) and cache.dtype == dtype:
+			res = np.zeros((bottom - top, (right - left)*4), dtype=dtype)
+			res3 = res.reshape(bottom - top, right - left, 4)
+			y0, x0 = max(top, 0), max(left, 0)
+			y1, x1 = min(bottom, self.size[1]), min(right, self.size[0])
+			if y0 < y1 and x0 < x1:
+				for i, c in enumerate("RGBA"):
+					res3[y0 - top : y1 - top, x0 - left : x1 - left, order.index(c)] = cache[y0 : y1, x0 : x1, i]
+			return res
+
+		res = np.zeros((bottom - top, (right - left)*4), dtype=dtype)
+		# a single tile: each layer is read once
+		self._composite(res.reshape(bottom - top, right - left, 4), (top, left, bottom, right), order, max(bottom - top, right - left, 1), 1, partial=True)
 		return res
 
+	def iter_fusioned_bands(self, order="ARGB", tile_size=256, workers=None):
+		# merged image as successive bands of tile_size rows: only one band
+		# is in memory at once
+		# the channels not decoded yet are not kept decoded: only the rows of
+		# each band are read from raw and RLE channels, ZIP channels are
+		# decoded for the bands they cover, and released after
+		total_width, total_height = self.size
+		layers = [layer for layer in self.iter_displayed_layers() if layer.opacity]
+		decoded = set(channel for layer in layers for channel in layer.channels if channel.is_decoded())
+		executor = ThreadPoolExecutor(workers) if workers != 1 else None
+
+		def read_rows(job):
+			# rows y0 ... y1 of the canvas of a channel
+			layer, channel, y0, y1, l_top = job
+			if channel.is_decoded() or not channel.has_row_access():
+				return channel.data[y0 - l_top : y1 - l_top]
+			return channel.read_region(y0 - l_top, 0, y1 - l_top, channel.width)
+
+		try:
+			for top in range(0, total_height, tile_size):
+				bottom = min(top + tile_size, total_height)
+				jobs = []
+				for layer in layers:
+					l_top, l_left, l_bottom, l_right = layer.get_bounding_box()
+					y0, y1 = max(top, l_top), min(bottom, l_bottom)
+					if y0 < y1 and l_left < l_right:
+						jobs += [(layer, channel, y0, y1, l_top) for channel in layer.channels]
+				rows = list(executor.map(read_rows, jobs)) if executor is not None else [read_rows(job) for job in jobs]
+				bands = {}
+				for (layer, _, y0, _, _), channel_rows in zip(jobs, rows):
+					bands.setdefault(layer, (y0, []))[1].append(channel_rows)
+
+				res = np.zeros((bottom - top, total_width*4), dtype=_depth_dtype(self.depth))
+				self._composite(res.reshape(bottom - top, total_width, 4), (top, 0, bottom, total_width), order, tile_size, workers, bands=bands)
+				del rows, bands
+
+				# channels decoded for this band whose layer ends in it
+				for layer in layers:
+					if layer.get_bounding_box()[2] <= bottom:
+						for channel in layer.channels:
+							if channel not in decoded:
+								channel.evict()
+				yield res
+
+		finally:
+			for layer in layers:
+				for channel in layer.channels:
+					if channel not in decoded:
+						channel.evict()
+			if executor is not None:
+				executor.shutdown()
+
+	def _composite(self, res, rect, order, tile_size, workers, partial=False, bands=None):
+		# composite the rectangle rect (top, left, bottom, right) of the
+		# canvas in res, a (h, w, 4) array of the size of rect
+		# partial: read only the needed part of the channels not decoded yet
+		# bands: channel rows already read for the layers covering rect, see
+		# _blend_layers
+		top, left, bottom, right = rect
+		layers = [layer for layer in self.iter_displayed_layers() if layer.opacity]
+		boxes = np.array([layer.get_bounding_box() for layer in layers], dtype=np.int64).reshape(-1, 4)
+
+		if not partial and bands is None and workers != 1:
+			# channels still to decode are decoded once, in parallel, rather
+			# than by the first tiles needing them
+			inside = (boxes[:, 0] < bottom) & (boxes[:, 2] > top) & (boxes[:, 1] < right) & (boxes[:, 3] > left)
+			pending = [channel for i in np.flatnonzero(inside) for channel in layers[i].channels if not channel.is_decoded()]
+			if len(pending) > 1:
+				with ThreadPoolExecutor(workers) as executor:
+					for _ in executor.map(lambda channel: channel.data, pending):
+						pass
+
+		def composite_tile(tile):
+			y0, x0, y1, x1 = tile
+			covering = np.flatnonzero(
+				(boxes[:, 0] < y1) & (boxes[:, 2] > y0) & (boxes[:, 1] < x1) & (boxes[:, 3] > x0))
+			if len(covering) == 0:
+				# nothing to draw: res is already transparent
+				return
+			rgb, alpha = _blend_layers([layers[i] for i in covering], tile, partial, bands)
+			_store_blended(res[y0 - top : y1 - top, x0 - left : x1 - left], rgb, alpha, order)
+
+		tiles = [
+			(y, x, min(y + tile_size, bottom), min(x + tile_size, right))
+			for y in range(top, bottom, tile_size)
+			for x in range(left, right, tile_size)
+		]
+		if workers == 1 or len(tiles) <= 1:
+			for tile in tiles:
+				composite_tile(tile)
+		else:
+			# numpy releases the GIL, and tiles never overlap
+			with ThreadPoolExecutor(workers) as executor:
+				for _ in executor.map(composite_tile, tiles):
+					pass
+
 	def save_fusioned_as_png(self, path):
-		fusion = self.get_fusioned_image("RGBA")
-		png.from_array(fusion, mode="RGBA").save(path)
-		
+		f = open(path, 'wb')
+		self._write_fusioned_png(f)
+		f.close()
+
+	def _write_fusioned_png(self, f):
+		# the merged image is streamed by bands to the png writer
+		total_width, total_height = self.size
+		bitdepth = 8 if self.depth == 8 else 16
+		rows = (row for band in self.iter_fusioned_bands("RGBA") for row in _png_rows(band)[0])
+		png.Writer(total_width, total_height, greyscale=False, alpha=True, bitdepth=bitdepth).write(f, rows)
+
+	async def save_async(self, path, compression=None, workers=None, executor=None, chunk_size=0x100000, max_pending=8, cache=None):
+		# save without blocking the event loop: the file is encoded in
+		# executor (None for the loop's default one) while the encoded
+		# chunks are written, see _write_async
+		await _write_async(path, lambda f: self.write_to_buffer(FileBuffer(f), compression, workers, cache=cache), executor, chunk_size, max_pending)
+
+	async def save_fusioned_as_png_async(self, path, executor=None, chunk_size=0x100000, max_pending=8):
+		await _write_async(path, self._write_fusioned_png, executor, chunk_size, max_pending)
+		
+
+def _blend_layers(layers, rect, partial=False, bands=None):
+	# "normal" blending (source over) of layers, from bottom to top, on the
+	# rectangle rect (top, left, bottom, right) of the canvas
+	# partial: read only the needed part of the channels not decoded yet
+	# bands: {layer: (top, channel rows)}, rows of the channels already read
+	# from the canvas row top, used instead of the channels
+	# returns the premultiplied (h, w, 3) rgb and (h, w) alpha, as floats
+	top, left, bottom, right = rect
+	rgb = np.zeros((bottom - top, right - left, 3), dtype=np.float32)
+	alpha = np.zeros((bottom - top, right - left), dtype=np.float32)
+
+	for layer in layers:
+		l_top, l_left, l_bottom, l_right = layer.get_bounding_box()
+		y0, x0 = max(top, l_top), max(left, l_left)
+		y1, x1 = min(bottom, l_bottom), min(right, l_right)
+		if y0 >= y1 or x0 >= x1:
+			continue
+
+		if bands is not None and layer in bands:
+			b_top, band = bands[layer]
+			src = [rows[y0 - b_top : y1 - b_top, x0 - l_left : x1 - l_left] for rows in band]
+		elif partial:
+			src = [channel.read_region(y0 - l_top, x0 - l_left, y1 - l_top, x1 - l_left) for channel in layer.channels]
+		else:
+			src = [channel.data[y0 - l_top : y1 - l_top, x0 - l_left : x1 - l_left] for channel in layer.channels]
+		# components are normalized to 0 ... 1
+		scale = np.float32(1. / _max_value(src[0].dtype))
+		src_alpha = src[0] * (scale * np.float32(layer.opacity / 255.))
+		dst_rgb = rgb[y0 - top : y1 - top, x0 - left : x1 - left]
+		dst_alpha = alpha[y0 - top : y1 - top, x0 - left : x1 - left]
+
+		# dst = src * src_alpha + dst * (1 - src_alpha)
+		inv_alpha = 1 - src_alpha
+		for k in range(3):
+			dst_rgb[:, :, k] *= inv_alpha
+			dst_rgb[:, :, k] += src[k + 1] * (src_alpha * scale)
+		dst_alpha *= inv_alpha
+		dst_alpha += src_alpha
+
+	return rgb, alpha
+
+def _store_blended(res, rgb, alpha, order):
+	# store the result of _blend_layers in res, a (h, w, 4) array whose
+	# components are in the given order
+	max_value = _max_value(res.dtype)
+	# rounding of integer samples
+	rounding = .5 if res.dtype.kind != 'f' else 0.
+	covered = alpha > 0
+	rgb[covered] *= (max_value / alpha[covered])[:, None]
+	res[:, :, order.index("R")] = rgb[:, :, 0] + rounding
+	res[:, :, order.index("G")] = rgb[:, :, 1] + rounding
+	res[:, :, order.index("B")] = rgb[:, :, 2] + rounding
+	res[:, :, order.index("A")] = alpha * max_value + rounding
 
 # ===========================================================================
 # Reader functions
 # ===========================================================================
 
 	
-def _read_uncompressed_layer(buf, w, h):
+def _read_uncompressed_layer(buf, w, h, pos=-1, copy=True, depth=8):
+	# without copy, the result is a view on the buffer data
+	if pos == -1:
+		pos = buf.index
 	size = w*h
-	res = np.array(buf.data[buf.index : buf.index + size], dtype = np.uint8)
+	res = np.frombuffer(buf.data, dtype = _file_dtype(depth), count = size, offset = buf.start + pos)
+	if copy:
+		res = res.copy()
 	res.shape = (h, w)
 	return res
 
-def _read_compressed_layer(buf, w, h):
-	buf.save_state()
-	for _ in range(h):
-		buf.read_w()
-	size = w*h
-	unc = np.zeros(size, dtype = np.uint8)
-	i = 0
-	
-	while i < size:
-		hdr = buf.read_b(signed = True)
-		if hdr >= 0:
-			n = hdr + 1
-			unc[i : i + n] = buf.data[buf.index : buf.index + n]
-			i += n
-			buf.index += n
-		elif hdr > -128:
-			v = buf.read_b()
-			n = 1 - hdr
-			unc[i : i + n] = v
-			i += n	
+def _unpack_bits(data, offset, row_sizes, size):
+	# PackBits decoder working on whole channels
+	# data : any object supporting the buffer protocol
+	# offset : position of the first compressed row in data
+	# row_sizes : byte count of each compressed row
+	# size : expected number of decoded bytes
+	#
+	# Only the run headers are visited in Python: each row is scanned
+	# independently using its byte count, then every source byte gets a
+	# repeat count (0 for headers, 1 for literals, n for a repeated byte)
+	# and the whole channel is expanded at once with np.repeat.
+	packed_size = int(row_sizes.sum())
+	src = np.frombuffer(data, dtype=np.uint8, count=packed_size, offset=offset)
+
+	headers = []
+	add_header = headers.append
+	pos = 0
+	for row_size in row_sizes.tolist():
+		end = pos + row_size
+		while pos < end:
+			hdr = data[offset + pos]
+			add_header(pos)
+			if hdr < 128:
+				pos += hdr + 2
+			elif hdr > 128:
+				pos += 2
+			else:
+				pos += 1
+		if pos != end:
+			raise Exception("corrupted RLE row at %X" % (offset + end))
+
+	headers = np.array(headers, dtype=np.intp)
+	hdr = src[headers]
+	repeats = headers[hdr > 128]
+
+	counts = np.ones(packed_size, dtype=np.intp)
+	counts[headers] = 0
+	counts[repeats + 1] = 257 - src[repeats].astype(np.intp)
+
+	res = np.repeat(src, counts)
+	if len(res) != size:
+		raise Exception("bad RLE data size at %X: %d bytes instead of %d" % (offset, len(res), size))
+	return res
+
+def _row_sizes_dtype(version):
+	# type of the RLE row byte counts: words, longs in PSB files
+	return np.dtype('>u4' if version == 2 else '>u2')
+
+def _read_compressed_layer(buf, w, h, pos=-1, version=1, depth=8):
+	# h * 2 : byte counts for each row, followed by the PackBits rows
+	# (**PSB** h * 4)
+	# 16 and 32 bits samples are packed as big endian bytes
+	if pos == -1:
+		pos = buf.index
+	row_sizes_dtype = _row_sizes_dtype(version)
+	row_sizes = buf.read_array(h, row_sizes_dtype, pos)
+	dtype = _file_dtype(depth)
+	unc = _unpack_bits(buf.data, buf.start + pos + h*row_sizes_dtype.itemsize, row_sizes, w*h*dtype.itemsize)
+	unc = unc.view(dtype)
 	unc.shape = (h, w)
-	
-	buf.restore_state()
 	return unc
 
-def load_psd(path):
-	source = Buffer.load(path)
-
+def _read_zip_layer(buf, w, h, pos, length, prediction=False, depth=8):
+	# zlib stream of length bytes, with (compression 3) or without
+	# (compression 2) prediction
+	start = buf.start + pos
+	data = zlib.decompress(memoryview(buf.data)[start : start + length])
+	dtype = _file_dtype(depth)
+	if len(data) != w*h*dtype.itemsize:
+		raise Exception("bad ZIP data size at %X: %d bytes instead of %d" % (pos, len(data), w*h*dtype.itemsize))
+	unc = np.frombuffer(bytearray(data), dtype=np.uint8)
+	unc.shape = (h, w*dtype.itemsize)
+	if prediction:
+		return _unpredict(unc, depth)
+	return unc.view(dtype)
+
+def _read_channel(buf, w, h, pos, copy=True, version=1, depth=8, length=None):
+	# channel image data: compression flag (2) followed by the image data
+	# length: size of the channel image data (needed for ZIP data)
+	# buf index is left untouched
+	compression = buf.read_w(pos)
+	if compression == 1:
+		return _read_compressed_layer(buf, w, h, pos + 2, version, depth)
+	elif compression == 0:
+		return _read_uncompressed_layer(buf, w, h, pos + 2, copy, depth)
+	elif compression in (2, 3):
+		return _read_zip_layer(buf, w, h, pos + 2, length - 2, compression == 3, depth)
+	raise Exception("bad compression flag at %X" % pos)
+
+def _read_channel_region(buf, w, h, pos, rect, version=1, depth=8, length=None):
+	# part rect (top, left, bottom, right) of a channel, decoding only what
+	# is needed: raw data is a strided view on buf, only the rows of rect are
+	# unpacked for RLE data, and ZIP streams are inflated up to the last row
+	# of rect
+	top, left, bottom, right = rect
+	dtype = _file_dtype(depth)
+	compression = buf.read_w(pos)
+	pos += 2
+	if compression == 0:
+		return _read_uncompressed_layer(buf, w, h, pos, False, depth)[top : bottom, left : right]
+	elif compression == 1:
+		# the row byte counts give the position of the first row of rect
+		row_sizes = buf.read_array(h, _row_sizes_dtype(version), pos)
+		offset = buf.start + pos + h*row_sizes.itemsize + int(row_sizes[:top].sum(dtype=np.int64))
+		unc = _unpack_bits(buf.data, offset, row_sizes[top : bottom], (bottom - top)*w*dtype.itemsize)
+		unc = unc.view(dtype)
+		unc.shape = (bottom - top, w)
+		return unc[:, left : right]
+	elif compression in (2, 3):
+		start = buf.start + pos
+		data = zlib.decompressobj().decompress(memoryview(buf.data)[start : start + length - 2], bottom*w*dtype.itemsize)
+		if len(data) != bottom*w*dtype.itemsize:
+			raise Exception("bad ZIP data size at %X" % pos)
+		unc = np.frombuffer(bytearray(data), dtype=np.uint8)
+		unc.shape = (bottom, w*dtype.itemsize)
+		unc = unc[top:]
+		if compression == 3:
+			return _unpredict(unc, depth)[:, left : right]
+		return unc.view(dtype)[:, left : right]
+	raise Exception("bad compression flag at %X" % (pos - 2))
+
+def _read_channel_from_file(path, w, h, pos, version, depth, length):
+	# process pool worker: decode one channel straight from the file
+	return _read_channel(Buffer.load(path, memory_map=True), w, h, pos, version=version, depth=depth, length=length)
+
+def _read_channels(source, path, jobs, workers, processes=False, copy=True, version=1, depth=8):
+	# decode channels in a pool of workers
+	# jobs: list of (channel, offset) of channels to decode from source
+	ws = [channel.width for channel, _ in jobs]
+	hs = [channel.height for channel, _ in jobs]
+	offsets = [offset for _, offset in jobs]
+	lengths = [channel.source_length for channel, _ in jobs]
+
+	if processes:
+		with ProcessPoolExecutor(workers) as executor:
+			chunksize = max(1, len(jobs) // (4 * workers))
+			res = executor.map(_read_channel_from_file, [path] * len(jobs), ws, hs, offsets, [version] * len(jobs), [depth] * len(jobs), lengths, chunksize=chunksize)
+			res = list(res)
+	else:
+		# the numpy parts of the decoders release the GIL
+		with ThreadPoolExecutor(workers) as executor:
+			res = list(executor.map(
+				lambda w, h, offset, length: _read_channel(source, w, h, offset, copy, version, depth, length),
+				ws, hs, offsets, lengths))
+
+	for (channel, _), data in zip(jobs, res):
+		# decoded, not modified (read only, see PsdChannel.data)
+		data.flags.writeable = False
+		channel._data = data
+
+def _read_header(source):
+	# File Header and Color Mode Data sections
+	# returns version, nb_channels, width, height, depth, color_mode and
+	# palette (ARGB, for indexed color images), and leaves source at the
+	# start of the Image Resources section
 	assert source.read_string(n_chars = 4) == "8BPS"
 
-	source.read_w()
+	# 1 = PSD, 2 = PSB (Large Document Format)
+	version = source.read_w()
+	if version not in (1, 2):
+		raise Exception("Unsupported version: %d" % version)
 	source.advance_index_by(6)
 
 	pic_nb_channels = source.read_w()
 	pic_height = source.read_l()
 	pic_width = source.read_l()
 	pic_depth = source.read_w()
+	# check the depth is supported
+	_depth_dtype(pic_depth)
 	pic_color_mode = source.read_w()
+	pic_palette = None
 
 #	print("nb_channels: %d" % pic_nb_channels)
 #	print("width: %d" % pic_width)
@@ -546,22 +1895,62 @@ def load_psd(path):
 		raise Exception("Unsupported color mode")
 	if pic_color_mode == 2:
 		pic_palette = np.zeros((256, 4), dtype=np.uint8)
-		for x in range(256):
-			pic_palette[x, 0] = 0xFF
-			pic_palette[x, 1] = source.read_b()
-			pic_palette[x, 2] = source.read_b()
-			pic_palette[x, 3] = source.read_b()
+		pic_palette[:, 0] = 0xFF
+		pic_palette[:, 1:] = source.read_array(768).reshape(256, 3)
 		
 #	source.advance_index_by(length)
 
+	return version, pic_nb_channels, pic_width, pic_height, pic_depth, pic_color_mode, pic_palette
+
+def load_psd(path, memory_map=False, lazy=False, on_decode=None, workers=None, processes=False, stats=None, pass_through=True):
+	# memory_map: map the file instead of reading it, uncompressed channels
+	# are then views on the mapping and only paged in when used
+	# lazy: only read the layer records, channels are decoded the first
+	# time their data is used; on_decode(channel) is then called after
+	# each decoding (e.g. to evict other channels)
+	# workers: decode the channels in a pool of worker threads (or
+	# processes if processes is True), None to decode them serially
+	# stats: PsdStats collecting the timings of the sections
+	# pass_through: keep the file data, for the unmodified channels and
+	# merged image to be copied from it when saving (see
+	# PsdChannel.is_pass_through); uncompressed channels are then views on
+	# it. Without it, the decoded channels are all that is kept of the
+	# file (the file data is kept anyway by lazy and memory mapped loads)
+	if stats is not None:
+		stats.start()
+	source = Buffer.load(path, memory_map=memory_map)
+	if stats is not None:
+		stats.end_section("file", 0, size=0 if memory_map else len(source))
+	return _load_psd(source, path, memory_map, lazy, on_decode, workers, processes, stats, pass_through)
+
+def _load_psd(source, path, memory_map=False, lazy=False, on_decode=None, workers=None, processes=False, stats=None, pass_through=True):
+	# load_psd on the file data already in source (path is only used by
+	# the process workers)
+	pass_through = pass_through or lazy or memory_map
+	# uncompressed channels are views on the file data if it is kept
+	copy = not pass_through
+	version, pic_nb_channels, pic_width, pic_height, pic_depth, pic_color_mode, pic_palette = _read_header(source)
+	if stats is not None:
+		stats.end_section("header", source.index)
+
 	image_ressource_section = source.index
 #	print("image ressource section starts at %X" % image_ressource_section)
+	has_merged_data = _has_real_merged_data(source)
 	
 	layer_info_section = image_ressource_section + source.read_l(image_ressource_section) + 4
 #	print("layer info section starts at %X" % layer_info_section)
 	
-	source.set_index(layer_info_section + 8)
-	nb_layers = source.read_w()
+	# skip the lengths of the layer and mask information and layer info
+	# sections (**PSB** 8 bytes each)
+	if stats is not None:
+		stats.end_section("image_resources", layer_info_section)
+	layer_count_pos = _layer_count_pos(lambda pos, n: int.from_bytes(source.data[source.start + pos : source.start + pos + n], 'big'), layer_info_section, version)
+	if layer_count_pos is None:
+		nb_layers = 0
+	else:
+		source.set_index(layer_count_pos)
+		# negative if the first alpha channel is the merged transparency
+		nb_layers = abs(source.read_w(signed = True))
 
 	layers = []
 	
@@ -579,15 +1968,23 @@ def load_psd(path):
 		nb_channels = source.read_w() # nb_channels
 		channel_sizes = []
 		for _ in range(nb_channels):
-			source.read_w()
-			channel_sizes += [source.read_l()]
+			source.read_w() # channel id
+			if version == 2:
+				channel_sizes += [source.read_q()]
+			else:
+				channel_sizes += [source.read_l()]
 		
 		layer['channel_sizes'] = channel_sizes
 	
 		source.read_l() #8BIM
-		source.read_string(n_chars = 4)
-		source.read_l()
+		source.read_string(n_chars = 4) # blend mode
+		layer['opacity'] = source.read_b()
+		source.read_b() # clipping
+		flags = source.read_b()
+		layer['is_visible'] = not flags & 2
+		source.read_b() # filler
 		delta = source.read_l()
+		extra_data_end = source.index + delta
 		source.save_state()
 
 #		 source.advance_index_by(delta)
@@ -600,33 +1997,51 @@ def load_psd(path):
 		layer_blending_range_size = source.read_l()
 		source.advance_index_by(layer_blending_range_size)
 		
-		# Layer Name
+		# Layer Name: Pascal string, padded to a multiple of 4 bytes
 		layer_name_size = source.read_b()
-		source.advance_index_by(layer_name_size)
-		
-		source.align()
-		if source.read_b(source.index) != 0x38:
-			source.read_w()
-
-		# unicode layer name
-		source.read_l() #8BIM
-		tag_ = source.read_string(n_chars = 4)
-		# print tag_
-		if tag_ == 'luni':
-			source.read_l()
-			sz = source.read_l()
-			name = ''
-			for _ in range(sz):
-				c = source.read_w()
-				name += chr(c)
-			layer['name'] = name
-		else:
-			# print 'no name'
-			layer['name'] = ''
+		layer['name'] = source.read_array(layer_name_size).tobytes().decode('utf8', 'replace')
+		source.advance_index_by(3 - layer_name_size % 4)
+
+		layer['section_type'] = 0
+		layer['layer_id'] = None
+
+		# Additional layer information: tagged blocks up to the end of the
+		# extra data field
+		while source.index + 12 <= extra_data_end:
+			if source.read_string(n_chars = 4) not in ("8BIM", "8B64"):
+				break
+			tag_ = source.read_string(n_chars = 4)
+			if version == 2 and tag_ in psb_long_keys:
+				block_size = source.read_q()
+			else:
+				block_size = source.read_l()
+			block_pos = source.index
+
+			if tag_ == 'luni':
+				# unicode layer name
+				sz = source.read_l()
+				name = source.read_array(sz, '>u2')
+				layer['name'] = name.tobytes().decode('utf-16-be', 'surrogatepass')
+			elif tag_ == 'lsct':
+				# section divider setting
+				layer['section_type'] = source.read_l()
+			elif tag_ == 'lyid':
+				layer['layer_id'] = source.read_l()
+
+			source.set_index(block_pos + block_size)
 		
 		source.restore_state()
 		source.advance_index_by(delta)
 		
+	# channel image data follows the layer records, each channel block
+	# starts right after the previous one
+	channel_offset = source.index
+	if stats is not None:
+		stats.end_section("layer_records", channel_offset)
+
+	# channels left to decode by the workers
+	jobs = []
+
 	result = []
 	for i, layer in enumerate(layers):
 		top, left, bottom, right = layer['rect']
@@ -640,34 +2055,396 @@ def load_psd(path):
 			raise Exception()
 		
 		elif pic_color_mode == 3:
+			if stats is not None:
+				layer_time = time.perf_counter()
 			for j in range(4):
-#				print("layer %d channel %d starts at %X" % (i, j, source.index))
-				is_compressed = source.read_w()
-				if is_compressed == 1:
-#					print("compressed data")
-					channels += [PsdChannel(j - 1, _read_compressed_layer(source, w, h))]
-				elif is_compressed == 0:
-#					print("uncompressed data")
-					channels += [PsdChannel(j - 1, _read_uncompressed_layer(source, w, h))]
+#				print("layer %d channel %d starts at %X" % (i, j, channel_offset))
+				if lazy:
+					channels += [PsdChannel(j - 1, size=(w, h), source=source, offset=channel_offset, on_decode=on_decode, version=version, depth=pic_depth, source_length=layer['channel_sizes'][j])]
+				elif workers is not None:
+					channels += [PsdChannel(j - 1, size=(w, h), source=source, offset=channel_offset, version=version, depth=pic_depth, source_length=layer['channel_sizes'][j])]
+					jobs += [(channels[-1], channel_offset)]
 				else:
-					raise Exception("bad compression flag at %X" % (source.index - 2))
-	
-				source.advance_index_by(layer['channel_sizes'][j] - 2)
+					data = _read_channel(source, w, h, channel_offset, copy=copy, version=version, depth=pic_depth, length=layer['channel_sizes'][j])
+					if pass_through:
+						channels += [PsdChannel(j - 1, data, source=source, offset=channel_offset, version=version, depth=pic_depth, source_length=layer['channel_sizes'][j])]
+					else:
+						channels += [PsdChannel(j - 1, data)]
+				channel_offset += layer['channel_sizes'][j]
+
+			# skip the other channels (e.g. masks)
+			channel_offset += sum(layer['channel_sizes'][4:])
+
+		if stats is not None:
+			# decoded here unless lazy or decoded by the workers
+			decoded = not lazy and workers is None
+			stats.add_layer(layer['name'], time.perf_counter() - layer_time if decoded else None, sum(layer['channel_sizes']), w * h if not lazy else 0)
 	
 		result += [
 			PsdLayer(
 				name = layer['name'],
 				offset = (left, top),
 				size = (w, h),
-				channels = channels
+				channels = channels,
+				opacity = layer['opacity'],
+				is_visible = layer['is_visible'],
+				section_type = layer['section_type'],
+				layer_id = layer['layer_id']
 			)
 		]
+	
+	if jobs:
+		_read_channels(source, path, jobs, workers, processes, copy=copy, version=version, depth=pic_depth)
+		if not pass_through:
+			for channel, _ in jobs:
+				channel.source = None
+				channel.data.flags.writeable = True
+	if stats is not None:
+		stats.end_section("channel_data", channel_offset, 0 if lazy else sum(entry["pixels"] for entry in stats.layers))
 				
-	return PsdFile(
+	psd = PsdFile(
 		(pic_width, pic_height), 
 		result,
-		color_mode = pic_color_mode)
+		color_mode = pic_color_mode,
+		version = version,
+		depth = pic_depth)
+
+	# the merged image can be saved as is while the layers are unchanged,
+	# if it has the channels PsdFile.save writes
+	if version == 2:
+		image_data_section = layer_info_section + 8 + source.read_q(layer_info_section)
+	else:
+		image_data_section = layer_info_section + 4 + source.read_l(layer_info_section)
+	if pass_through and has_merged_data and pic_nb_channels == (4 if pic_color_mode == 3 else 1) and image_data_section + 2 < len(source):
+		psd.merged_source = (source, image_data_section, len(source) - image_data_section, version, pic_depth, (pic_width, pic_height))
+	return psd
+
+
+def _layer_count_pos(read, pos, version):
+	# position of the layer count of the layer and mask information section
+	# at pos, None if there are no layers
+	# read(pos, n): n bytes integer at pos
+	# layers are in the layer info section, or for 16 and 32 bits documents
+	# saved by Photoshop (empty layer info section) in a Lr16 or Lr32 block
+	# of the additional layer information following the global layer mask
+	# info (section lengths are 8 bytes in PSB files)
+	n = 4*version
+	end = pos + n + read(pos, n)
+	pos += n
+	if pos + n > end:
+		return None
+	if read(pos, n) != 0:
+		return pos + n
+	pos += n
+
+	# Global layer mask info, if any
+	signatures = (int.from_bytes(b"8BIM", 'big'), int.from_bytes(b"8B64", 'big'))
+	if pos + 4 <= end and read(pos, 4) not in signatures:
+		pos += 4 + read(pos, 4)
+
+	# tagged blocks, their lengths rounded up to a multiple of 4
+	while pos + 12 <= end and read(pos, 4) in signatures:
+		key = read(pos + 4, 4).to_bytes(4, 'big').decode('latin-1')
+		length_size = 8 if version == 2 and key in psb_long_keys else 4
+		length = read(pos + 8, length_size)
+		pos += 8 + length_size
+		if key in ('Lr16', 'Lr32'):
+			return pos
+		pos += (length + 3) & ~3
+	return None
+
+def _layer_records_end(data, size):
+	# position of the end of the layer records, from the first size bytes
+	# of the file data (0 without layers), None if the records are not all
+	# in these bytes
+	def read(pos, n):
+		if pos + n > size:
+			raise EOFError()
+		return int.from_bytes(data[pos : pos + n], 'big')
+
+	try:
+		version = read(4, 2)
+		# header, then color mode data and image resources sections
+		pos = 26
+		pos += 4 + read(pos, 4)
+		pos += 4 + read(pos, 4)
+		pos = _layer_count_pos(read, pos, version)
+		if pos is None:
+			# no layers
+			return 0
+		nb_layers = read(pos, 2)
+		if nb_layers >= 0x8000:
+			nb_layers = 0x10000 - nb_layers
+		pos += 2
+		for _ in range(nb_layers):
+			# rectangle, channel information, blend mode, opacity...
+			pos += 18 + read(pos + 16, 2) * (2 + 4*version)
+			# ... and extra data
+			pos += 16 + read(pos + 12, 4)
+		read(pos, 0)
+	except EOFError:
+		return None
+	return pos
+
+async def load_psd_async(path, lazy=False, on_decode=None, executor=None, chunk_size=0x100000, max_pending=8):
+	# load_psd without blocking the event loop: the file is read by chunks
+	# (in the loop's default executor), and the channels are decoded in
+	# executor as soon as their data is read, so decoding overlaps the
+	# reading of the rest of the file
+	# max_pending: number of channels decoding at once; reading waits for
+	# the oldest one beyond that (backpressure)
+	# lazy, on_decode: see load_psd, with lazy the channels are not decoded
+	loop = asyncio.get_running_loop()
+	pending = []
+	f = open(path, 'rb')
+	data = bytearray(os.fstat(f.fileno()).st_size)
+	view = memoryview(data)
+	try:
+		source = Buffer(data)
+		source.path = path
+		source.path_stat = file_stat(f.fileno())
+		received = 0
+		psd = None
+		channels = []
 
+		while True:
+			if psd is None and _layer_records_end(data, received) is not None:
+				# the layer records are read: their channels are known
+				psd = await loop.run_in_executor(executor, _load_psd, source, path, False, True, on_decode)
+				if not lazy:
+					channels = [channel for layer in psd.layers for channel in layer.channels]
+					channels.sort(key = lambda channel: channel.offset)
+
+			while channels and channels[0].offset + channels[0].source_length <= received:
+				channel = channels.pop(0)
+				pending += [loop.run_in_executor(executor, getattr, channel, "data")]
+				if len(pending) > max_pending:
+					await pending.pop(0)
+
+			if received == len(data):
+				break
+			n = await loop.run_in_executor(None, f.readinto, view[received : received + chunk_size])
+			if not n:
+				raise Exception("Unexpected end of file %s" % path)
+			received += n
+
+		if psd is None:
+			raise Exception("Truncated layer records in %s" % path)
+		for future in pending:
+			await future
+		pending = []
+		return psd
+
+	finally:
+		# on errors or cancellation, decodings not started are cancelled
+		for future in pending:
+			future.cancel()
+		view.release()
+		f.close()
+
+class _AsyncWriter:
+	# file-like object written from a worker thread: the data is queued by
+	# chunks to the event loop, which writes them to the file; the queue is
+	# bounded, so the worker waits when the file lags behind
+	def __init__(self, loop, queue, chunk_size):
+		self.loop = loop
+		self.queue = queue
+		self.chunk_size = chunk_size
+		self.cancelled = False
+		self.pos = 0
+		# data written at pending_pos and not queued yet
+		self.pending = bytearray()
+		self.pending_pos = 0
+
+	def tell(self):
+		return self.pos
+
+	def seek(self, pos):
+		self.flush()
+		self.pos = self.pending_pos = pos
+
+	def write(self, data):
+		self.pending += data
+		self.pos += len(data)
+		if len(self.pending) >= self.chunk_size:
+			self.flush()
+		return len(data)
+
+	def flush(self):
+		if self.pending:
+			self.put((self.pending_pos, self.pending))
+			self.pending = bytearray()
+		self.pending_pos = self.pos
+
+	def put(self, item):
+		if self.cancelled:
+			raise Exception("Writing cancelled")
+		asyncio.run_coroutine_threadsafe(self.queue.put(item), self.loop).result()
+
+@contextlib.contextmanager
+def _replacing(path):
+	# file object to write the content of path to: a temporary file of the
+	# same directory, moved to path once closed without error (and removed
+	# on error), so that path is never truncated while it may still be read,
+	# e.g. a document memory mapped from it and saved to it
+	# a symbolic link at path is replaced by a regular file
+	directory = os.path.dirname(os.path.abspath(path))
+	while True:
+		temp_path = os.path.join(directory, "%s.%s.tmp" % (os.path.basename(path), os.urandom(4).hex()))
+		try:
+			# permissions of a new file (the umask applies)
+			fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+			break
+		except FileExistsError:
+			pass
+	try:
+		# permissions of the file replaced
+		mode = stat.S_IMODE(os.stat(path).st_mode)
+	except FileNotFoundError:
+		mode = None
+	f = os.fdopen(fd, 'wb')
+	try:
+		yield f
+		f.close()
+		if mode is not None:
+			os.chmod(temp_path, mode)
+		os.replace(temp_path, path)
+	except BaseException:
+		f.close()
+		os.unlink(temp_path)
+		raise
+
+def _write_at(f, pos, data):
+	f.seek(pos)
+	f.write(data)
+
+async def _write_async(path, write, executor=None, chunk_size=0x100000, max_pending=8):
+	# write(f) runs in executor and writes to f, a file-like object whose
+	# data is written to path without blocking the loop; at most max_pending
+	# chunks of about chunk_size bytes wait to be written (backpressure)
+	loop = asyncio.get_running_loop()
+	queue = asyncio.Queue(max_pending)
+	writer = _AsyncWriter(loop, queue, chunk_size)
+
+	def produce():
+		try:
+			write(writer)
+			writer.flush()
+		finally:
+			if not writer.cancelled:
+				writer.put(None)
+
+	# the file is written by a thread of its own: producers blocked on the
+	# queue may hold all the threads of executor (by default the loop's
+	# default executor, shared by concurrent calls)
+	file_executor = ThreadPoolExecutor(1)
+
+	# written to a temporary file replacing path at the end (see _replacing)
+	with _replacing(path) as f:
+		producer = loop.run_in_executor(executor, produce)
+		try:
+			while True:
+				item = await queue.get()
+				if item is None:
+					break
+				pos, data = item
+				await loop.run_in_executor(file_executor, _write_at, f, pos, data)
+			await producer
+
+		except BaseException:
+			# stop the producer: it fails on its next chunk, once unblocked
+			writer.cancelled = True
+			while not queue.empty():
+				queue.get_nowait()
+			producer.add_done_callback(lambda future: future.cancelled() or future.exception())
+			raise
+
+		finally:
+			# a cancelled write ends before the file is closed
+			file_executor.shutdown()
+
+def _has_real_merged_data(source):
+	# Image Resources section (at source index, left at its end): the
+	# hasRealMergedData flag of the Version Info resource (True without it)
+	has_merged_data = True
+	end = source.index + 4 + source.read_l()
+	while source.index + 12 <= end:
+		if source.read_string(n_chars = 4) != "8BIM":
+			break
+		resource_id = source.read_w()
+		# name: Pascal string, padded to make the size even
+		name_size = source.read_b()
+		source.advance_index_by(name_size + 1 - name_size % 2)
+		resource_size = source.read_l()
+		if resource_id == 0x421:
+			# 4 bytes version, followed by hasRealMergedData
+			has_merged_data = source.read_b(source.index + 4) != 0
+		source.advance_index_by(resource_size + resource_size % 2)
+	source.set_index(end)
+	return has_merged_data
+
+def load_composite(path, order="ARGB", memory_map=False):
+	# merged image stored in the Image Data section, as a PngArray: the
+	# layers are neither read nor composited, unless the file has no real
+	# merged data (Version Info resource)
+	# the Layer and Mask Information section is skipped without being read
+	# (nor paged in, with memory_map)
+	if memory_map:
+		source = Buffer.load(path, memory_map=True)
+		image_data = source
+	else:
+		with open(path, 'rb') as f:
+			# header, Color Mode Data and Image Resources sections
+			head = f.read(26)
+			for _ in range(2):
+				length = f.read(4)
+				head += length + f.read(int.from_bytes(length, 'big'))
+			# Layer and Mask Information section (**PSB** 8 bytes length)
+			length_size = 4 * int.from_bytes(head[4 : 6], 'big')
+			f.seek(int.from_bytes(f.read(length_size), 'big'), os.SEEK_CUR)
+			image_data = Buffer(bytearray(f.read()))
+		source = Buffer(bytearray(head))
+
+	version, nb_channels, width, height, depth, color_mode, palette = _read_header(source)
+	has_merged_data = _has_real_merged_data(source)
+
+	if memory_map:
+		# skip the Layer and Mask Information section (**PSB** 8 bytes length)
+		if version == 2:
+			source.advance_index_by(source.read_q())
+		else:
+			source.advance_index_by(source.read_l())
+
+	# Image Data section: compression flag, then all the channels stored
+	# as one (nb_channels * height, width) plane
+	image_data_length = len(image_data) - image_data.index
+	if not has_merged_data or image_data_length <= 2 or color_mode not in (1, 2, 3):
+		return load_psd(path, memory_map=memory_map).get_fusioned_image(order)
+
+	# the image data is only used here: no need to copy it
+	data = _read_channel(image_data, width, height * nb_channels, image_data.index, copy=False, version=version, depth=depth, length=image_data_length)
+	planes = data.reshape(nb_channels, height, width)
+
+	dtype = _depth_dtype(depth)
+	res = np.empty((height, width, 4), dtype=dtype)
+	if color_mode == 2:
+		# indexed colors: the palette is in ARGB order
+		for i, c in enumerate("ARGB"):
+			res[:, :, order.index(c)] = palette[planes[0], i]
+		res.shape = (height, width*4)
+		return res
+
+	# RGB, or grayscale, optionally followed by the transparency
+	colors = planes[:3] if color_mode == 3 else planes[:1].repeat(3, axis=0)
+	nb_colors = 3 if color_mode == 3 else 1
+	for i, c in enumerate("RGB"):
+		res[:, :, order.index(c)] = colors[i]
+	if nb_channels > nb_colors:
+		res[:, :, order.index("A")] = planes[nb_colors]
+	else:
+		res[:, :, order.index("A")] = _max_value(dtype)
+	res.shape = (height, width*4)
+	return res
 
 if __name__ == '__main__':
 	if True: